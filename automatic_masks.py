@@ -0,0 +1,150 @@
+import threading
+
+import numpy as np
+import torch
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.utils.amg import batch_iterator, generate_crop_boxes, MaskData, uncrop_boxes_xyxy, uncrop_points
+from torchvision.ops.boxes import batched_nms
+
+from embedding_cache import EmbeddingCache, restore_predictor_state
+from mask_encoding import decode_mask_rle
+
+
+class SteppedMaskGenerator(SamAutomaticMaskGenerator):
+    def __init__(self, model, run_step=None, on_progress=None, **kwargs):
+        """分步执行的自动掩码生成器
+
+        每次裁剪图编码、每个点批次的解码器前向都经 run_step 单独提交（服务端用推理线程的后台队列），
+        步骤之间交互请求可以插队，交互请求最多等待一个批次（CPU上每个点约0.25秒，批次宜小）；
+        掩码后处理（阈值、稳定性评分、RLE）留在调用线程。on_progress(已处理点数, 总点数) 在每个批次后调用。
+        输出固定为非压缩RLE，避免同时持有几百张整图掩码。
+        """
+        kwargs.setdefault("output_mode", "uncompressed_rle")
+        super().__init__(model, **kwargs)
+        self.run_step = run_step or (lambda fn, *args, **kw: fn(*args, **kw))
+        self.on_progress = on_progress
+        self.embedding = None
+        self.processed_points = 0
+        self.total_points = 0
+        self._predict_torch = self.predictor.predict_torch
+        self.predictor.predict_torch = self._predict_torch_step
+
+    def _predict_torch_step(self, *args, **kwargs):
+        return self.run_step(self._predict_torch, *args, **kwargs)
+
+    def count_points(self, image_shape):
+        """整张图需要解码的提示点总数（所有裁剪层）"""
+        _, layer_idxs = generate_crop_boxes(image_shape[:2], self.crop_n_layers, self.crop_overlap_ratio)
+        return int(sum(len(self.point_grids[layer_idx]) for layer_idx in layer_idxs))
+
+    def generate(self, image, embedding=None):
+        """生成掩码记录；embedding为整图已有的嵌入时，第0层（整图）跳过图像编码"""
+        self.embedding = embedding
+        self.processed_points = 0
+        self.total_points = self.count_points(image.shape)
+        try:
+            return super().generate(image)
+        finally:
+            self.embedding = None
+
+    def _set_crop_image(self, cropped_im, crop_layer_idx):
+        if crop_layer_idx == 0 and self.embedding is not None:
+            restore_predictor_state(self.predictor, self.embedding)
+        else:
+            self.predictor.set_image(cropped_im)
+
+    def _process_crop(self, image, crop_box, crop_layer_idx, orig_size):
+        # 与 SamAutomaticMaskGenerator._process_crop 相同，只是裁剪图编码作为独立步骤执行
+        x0, y0, x1, y1 = crop_box
+        cropped_im = image[y0:y1, x0:x1, :]
+        cropped_im_size = cropped_im.shape[:2]
+        self.run_step(self._set_crop_image, cropped_im, crop_layer_idx)
+
+        points_scale = np.array(cropped_im_size)[None, ::-1]
+        points_for_image = self.point_grids[crop_layer_idx] * points_scale
+
+        data = MaskData()
+        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
+            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
+            data.cat(batch_data)
+            del batch_data
+            self.processed_points += len(points)
+            if self.on_progress is not None:
+                self.on_progress(self.processed_points, self.total_points)
+        self.predictor.reset_image()
+
+        keep_by_nms = batched_nms(
+            data["boxes"].float(),
+            data["iou_preds"],
+            torch.zeros(len(data["boxes"])),
+            iou_threshold=self.box_nms_thresh,
+        )
+        data.filter(keep_by_nms)
+
+        data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
+        data["points"] = uncrop_points(data["points"], crop_box)
+        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        return data
+
+
+class MaskBank:
+    def __init__(self, shape, records, max_area_fraction=0.8):
+        """自动生成掩码的像素索引：每个像素记录覆盖它的最小掩码，点击时直接查表
+
+        records 为 SteppedMaskGenerator 的输出（segmentation为非压缩RLE）；
+        覆盖超过 max_area_fraction 的背景类掩码不进入索引，点击这些位置时回退到实时解码。
+        """
+        self.shape = tuple(shape[:2])
+        max_area = max_area_fraction * self.shape[0] * self.shape[1]
+        records = sorted((r for r in records if r["area"] <= max_area), key=lambda r: r["area"], reverse=True)
+
+        # 从大到小绘制，小掩码覆盖大掩码
+        self.index = np.zeros(self.shape, dtype=np.uint16 if len(records) < 65535 else np.int32)
+        self.masks = [None]
+        for mask_id, record in enumerate(records, 1):
+            self.index[decode_mask_rle(record["segmentation"])] = mask_id
+            self.masks.append({
+                "rle": record["segmentation"],
+                "score": float(record["predicted_iou"]),
+                "stability_score": float(record["stability_score"]),
+                "area": int(record["area"]),
+                "bbox": [float(v) for v in record["bbox"]],
+            })
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.masks) - 1
+
+    def nbytes(self):
+        return int(self.index.nbytes + sum(len(m["rle"]["counts"]) * 8 for m in self.masks[1:]))
+
+    def mask_at(self, x, y):
+        """点击位置所在的最小掩码编号，未覆盖或越界时返回0"""
+        height, width = self.shape
+        x, y = int(x), int(y)
+        mask_id = int(self.index[y, x]) if 0 <= x < width and 0 <= y < height else 0
+        with self._lock:
+            if mask_id:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return mask_id
+
+    def mask(self, mask_id):
+        """解码指定掩码为原图尺寸的bool掩码"""
+        return decode_mask_rle(self.masks[mask_id]["rle"])
+
+    def stats(self):
+        with self._lock:
+            return {"masks": len(self), "hits": self.hits, "misses": self.misses}
+
+
+class MaskBankCache(EmbeddingCache):
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        """按图像哈希缓存 MaskBank"""
+        super().__init__(max_bytes=max_bytes)
+
+    def entry_bytes(self, entry):
+        return entry["bank"].nbytes()
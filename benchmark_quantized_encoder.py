@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+对比float32与int8动态量化图像编码器：编码耗时及掩码IoU偏差
+"""
+
+import time
+
+import cv2
+import numpy as np
+from segment_anything import SamPredictor
+
+from sam_loader import build_sam
+
+# 与校准脚本相同的测试点，覆盖楼层图的各个区域
+TEST_POINTS = [
+    [150, 120], [300, 120], [450, 120],
+    [150, 200], [300, 200], [450, 200],
+    [150, 300], [300, 300], [450, 300],
+    [441, 161],
+]
+
+
+def encode_and_predict(predictor, image_rgb, runs=3):
+    """编码图像并对所有测试点预测最佳掩码，返回 (编码耗时中位数, 各次编码耗时, 掩码列表)
+
+    先做一次不计时的预热编码，吸收首次运行的一次性开销（线程池、内存分配器初始化等），
+    避免先运行的模型被算慢。
+    """
+    predictor.set_image(image_rgb)
+    encode_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predictor.set_image(image_rgb)
+        encode_times.append(time.perf_counter() - start)
+
+    masks = []
+    for point in TEST_POINTS:
+        point_masks, scores, _ = predictor.predict(
+            point_coords=np.array([point]),
+            point_labels=np.array([1]),
+            multimask_output=True
+        )
+        masks.append(point_masks[np.argmax(scores)])
+    return float(np.median(encode_times)), encode_times, masks
+
+
+def mask_iou(mask_a, mask_b):
+    """计算两个掩码的IoU"""
+    union = np.logical_or(mask_a, mask_b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(mask_a, mask_b).sum() / union)
+
+
+def format_times(times):
+    return ", ".join(f"{t:.2f}s" for t in times)
+
+
+def benchmark_quantized_encoder(image_path="lumine-yurakucho.png", checkpoint_path="sam_vit_b_01ec64.pth", runs=3):
+    print("Loading image...")
+    image = cv2.imread(image_path)
+    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    print(f"Image shape: {image_rgb.shape}")
+
+    print("\n[float32] Loading SAM model...")
+    float_predictor = SamPredictor(build_sam(checkpoint_path))
+    float_time, float_times, float_masks = encode_and_predict(float_predictor, image_rgb, runs=runs)
+    print(f"[float32] Encoder time: median {float_time:.2f}s over {runs} warm runs ({format_times(float_times)})")
+    del float_predictor
+
+    print("\n[int8] Loading SAM model with quantized image encoder...")
+    int8_predictor = SamPredictor(build_sam(checkpoint_path, quantize_encoder=True))
+    int8_time, int8_times, int8_masks = encode_and_predict(int8_predictor, image_rgb, runs=runs)
+    print(f"[int8] Encoder time: median {int8_time:.2f}s over {runs} warm runs ({format_times(int8_times)})")
+
+    ious = [mask_iou(a, b) for a, b in zip(float_masks, int8_masks)]
+
+    print("\n" + "=" * 50)
+    print("Quantized encoder benchmark")
+    print("=" * 50)
+    print(f"Encoder speed-up (median of warm runs): {float_time / int8_time:.2f}x "
+          f"({float_time:.2f}s -> {int8_time:.2f}s)")
+    print(f"Mask IoU vs float32: mean={np.mean(ious):.4f}, min={np.min(ious):.4f}")
+    for point, iou in zip(TEST_POINTS, ious):
+        print(f"  point {point}: IoU={iou:.4f}")
+
+    return {"float_time": float_time, "int8_time": int8_time, "float_times": float_times,
+            "int8_times": int8_times, "ious": ious}
+
+
+if __name__ == "__main__":
+    benchmark_quantized_encoder()
@@ -54,15 +54,17 @@ def calibrate_store_positions():
         response = requests.post(f"{server_url}/api/predict", 
                                json={
                                    "points": [pos['point']],
-                                   "point_labels": [1]
+                                   "point_labels": [1],
+                                   "format": "polygon"
                                })
         
         if response.status_code == 200:
             result = response.json()
             if result["success"]:
-                mask_data = result["best_mask"]
-                center_point = calculate_center_point(mask_data)
-                area = count_mask_pixels(mask_data)
+                # 服务端直接返回中心点和面积，无需逐像素扫描掩码
+                best_polygon = result["best_polygon"]
+                center_point = best_polygon["center"] or {"x": 0, "y": 0}
+                area = best_polygon["area"]
                 
                 analysis = {
                     "区域名": pos['name'],
@@ -111,36 +113,5 @@ def calibrate_store_positions():
     print("2. 记录每个坐标点实际对应的店铺名称")
     print("3. 更新 detectStoreName 函数中的坐标范围")
 
-def calculate_center_point(mask_data):
-    """Calculate the center point of the mask"""
-    if not mask_data:
-        return {"x": 0, "y": 0}
-    
-    sum_x, sum_y, count = 0, 0, 0
-    height = len(mask_data)
-    
-    for y, row in enumerate(mask_data):
-        for x, pixel in enumerate(row):
-            if pixel > 0:
-                sum_x += x
-                sum_y += y
-                count += 1
-    
-    if count > 0:
-        return {"x": round(sum_x / count), "y": round(sum_y / count)}
-    return {"x": 0, "y": 0}
-
-def count_mask_pixels(mask_data):
-    """Count non-zero pixels in mask"""
-    if not mask_data:
-        return 0
-    
-    count = 0
-    for row in mask_data:
-        for pixel in row:
-            if pixel > 0:
-                count += 1
-    return count
-
 if __name__ == "__main__":
     calibrate_store_positions()
\ No newline at end of file
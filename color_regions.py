@@ -0,0 +1,199 @@
+import threading
+
+import cv2
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+# 与原先逐点 inRange 相同的颜色容差
+COLOR_TOLERANCE = 30
+# 细量化步长：RGB各通道右移3位，共 32^3 个颜色桶
+FINE_SHIFT = 3
+
+
+def fine_color_index(image_rgb):
+    """每个像素的细量化颜色桶编号 (H, W) uint16"""
+    fine = image_rgb >> FINE_SHIFT
+    return ((fine[..., 0].astype(np.uint16) << 10) | (fine[..., 1].astype(np.uint16) << 5)
+            | fine[..., 2].astype(np.uint16))
+
+
+def fine_bin_colors():
+    """全部细量化颜色桶的中心颜色 (32768, 3)"""
+    bins = np.arange(1 << 15)
+    levels = np.stack([bins >> 10, (bins >> 5) & 31, bins & 31], axis=1)
+    return (levels << FINE_SHIFT) + (1 << (FINE_SHIFT - 1))
+
+
+def build_palette(counts, tolerance=COLOR_TOLERANCE, min_area=64, max_colors=255):
+    """按像素数从多到少选取主色，与已选主色距离在容差内的颜色桶归入已有主色"""
+    bin_colors = fine_bin_colors()
+    palette = []
+    for bin_index in np.argsort(counts)[::-1]:
+        if counts[bin_index] < min_area or len(palette) >= max_colors:
+            break
+        color = bin_colors[bin_index]
+        if all(np.abs(color - chosen).max() > tolerance for chosen in palette):
+            palette.append(color)
+    return np.asarray(palette, dtype=np.int32).reshape(-1, 3)
+
+
+def palette_lut(palette, tolerance=COLOR_TOLERANCE):
+    """细量化颜色桶 -> 主色编号（1起，0表示不属于任何主色，如文字、抗锯齿边缘）"""
+    lut = np.zeros(1 << 15, dtype=np.uint8)
+    if len(palette) == 0:
+        return lut
+    bin_colors = fine_bin_colors()
+    best_distance = np.full(len(bin_colors), tolerance + 1, dtype=np.int32)
+    for label, color in enumerate(palette, 1):
+        # 与原逐通道容差一致，用切比雪夫距离
+        distance = np.abs(bin_colors - color).max(axis=1)
+        closer = distance < best_distance
+        lut[closer] = label
+        best_distance[closer] = distance[closer]
+    return lut
+
+
+def same_color_components(color_labels, min_area=64):
+    """同色连通域 (H, W) int32（0为背景），以及各连通域的面积和外接框 (x0, y0, x1, y1)
+
+    一次 connectedComponents 完成：与右/下邻居颜色不同的像素暂作分隔线，
+    剩余像素的4连通域必然同色；之后把分隔线像素并入同色的相邻连通域。
+    """
+    height, width = color_labels.shape
+    separator = np.zeros((height, width), dtype=bool)
+    separator[:, :-1] |= color_labels[:, :-1] != color_labels[:, 1:]
+    separator[:-1, :] |= color_labels[:-1, :] != color_labels[1:, :]
+    interior = (color_labels > 0) & ~separator
+    _, components, stats, _ = cv2.connectedComponentsWithStats(interior.astype(np.uint8), connectivity=4,
+                                                               ltype=cv2.CV_32S)
+
+    # 分隔线像素取同色左/上/右/下邻居的连通域编号
+    for dy, dx in ((0, -1), (-1, 0), (0, 1), (1, 0)):
+        target = (slice(max(dy, 0), height + min(dy, 0)), slice(max(dx, 0), width + min(dx, 0)))
+        source = (slice(max(-dy, 0), height + min(-dy, 0)), slice(max(-dx, 0), width + min(-dx, 0)))
+        take = ((components[target] == 0) & (color_labels[target] > 0) &
+                (color_labels[source] == color_labels[target]) & (components[source] > 0))
+        components[target][take] = components[source][take]
+
+    # 丢弃小连通域并重新紧凑编号
+    areas = np.bincount(components.ravel(), minlength=len(stats))
+    keep = areas >= min_area
+    keep[0] = False
+    remap = np.zeros(len(areas), dtype=np.int32)
+    remap[keep] = np.arange(1, int(keep.sum()) + 1)
+    components = remap[components]
+
+    # 并入的分隔线像素最多在内部连通域外1像素，外接框各向外扩1像素
+    x0, y0 = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+    x1, y1 = x0 + stats[:, cv2.CC_STAT_WIDTH], y0 + stats[:, cv2.CC_STAT_HEIGHT]
+    bboxes = np.stack([np.maximum(x0 - 1, 0), np.maximum(y0 - 1, 0),
+                       np.minimum(x1 + 1, width), np.minimum(y1 + 1, height)], axis=1).astype(np.int32)
+    bboxes[0] = (0, 0, width, height)
+    keep[0] = True
+    return components, areas[keep], bboxes[keep]
+
+
+class ColorRegionMap:
+    def __init__(self, image_rgb, tolerance=COLOR_TOLERANCE, min_area=64):
+        """图像的量化颜色标签图及同色连通域，初始化时计算一次，点击时只做查表
+
+        颜色先细量化到 32^3 个桶，再按像素数选出主色（容差内合并），每个像素映射到最近的主色；
+        色块内的文字、细线不属于任何主色，不会把色块切开。
+        """
+        smoothed = cv2.medianBlur(np.ascontiguousarray(image_rgb), 3)
+        index = fine_color_index(smoothed)
+        self.palette = build_palette(np.bincount(index.ravel(), minlength=1 << 15),
+                                     tolerance=tolerance, min_area=min_area)
+        self.color_labels = palette_lut(self.palette, tolerance)[index]
+        self.components, self.areas, self.bboxes = same_color_components(self.color_labels, min_area=min_area)
+        self.shape = self.components.shape
+        self._contours = {}
+        self._polygons = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.areas) - 1
+
+    def nbytes(self):
+        return int(self.color_labels.nbytes + self.components.nbytes + self.bboxes.nbytes + self.areas.nbytes)
+
+    def component_at(self, x, y, radius=2):
+        """点击位置所在的连通域编号；点在文字或边线上时取邻域内最多的连通域，找不到返回0"""
+        height, width = self.shape
+        x, y = int(x), int(y)
+        if not (0 <= x < width and 0 <= y < height):
+            return 0
+        component = int(self.components[y, x])
+        if component or radius <= 0:
+            return component
+        window = self.components[max(y - radius, 0):y + radius + 1, max(x - radius, 0):x + radius + 1]
+        window = window[window > 0]
+        return int(np.bincount(window).argmax()) if window.size else 0
+
+    def contour(self, component):
+        """连通域的外轮廓（原图坐标，N x 2），按连通域缓存"""
+        with self._lock:
+            cached = self._contours.get(component)
+        if cached is not None:
+            return cached
+
+        x0, y0, x1, y1 = self.bboxes[component]
+        crop = (self.components[y0:y1, x0:x1] == component).astype(np.uint8)
+        contours, _ = cv2.findContours(crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contour = max(contours, key=cv2.contourArea).reshape(-1, 2) + np.array([x0, y0])
+        with self._lock:
+            return self._contours.setdefault(component, contour)
+
+    def component_mask(self, component, fill_holes=True):
+        """连通域的原图尺寸布尔掩码；fill_holes=True 时填充色块内部文字等留下的空洞"""
+        mask = np.zeros(self.shape, dtype=np.uint8)
+        if fill_holes:
+            cv2.drawContours(mask, [self.contour(component).reshape(-1, 1, 2).astype(np.int32)], -1, 1, cv2.FILLED)
+        else:
+            x0, y0, x1, y1 = self.bboxes[component]
+            mask[y0:y1, x0:x1] = self.components[y0:y1, x0:x1] == component
+        return mask.astype(bool)
+
+    def polygon_info(self, component, epsilon_ratio=0.005):
+        """连通域的简化多边形、中心点、边界框和面积（填充空洞后），格式与 mask_to_polygon 相同，按连通域缓存"""
+        with self._lock:
+            cached = self._polygons.get(component)
+        if cached is not None:
+            return cached
+
+        contour = self.contour(component).reshape(-1, 1, 2).astype(np.int32)
+        approx = cv2.approxPolyDP(contour, epsilon_ratio * cv2.arcLength(contour, True), True)
+        x, y, w, h = cv2.boundingRect(contour)
+        filled = np.zeros((h, w), dtype=np.uint8)
+        cv2.drawContours(filled, [contour - np.array([x, y])], -1, 1, cv2.FILLED)
+        moments = cv2.moments(contour)
+        if moments["m00"] != 0:
+            center = {"x": int(moments["m10"] / moments["m00"]), "y": int(moments["m01"] / moments["m00"])}
+        else:
+            center = {"x": x + (w - 1) // 2, "y": y + (h - 1) // 2}
+        info = {
+            "polygon": [{"x": int(p[0][0]), "y": int(p[0][1])} for p in approx],
+            "center": center,
+            "bbox": {"x": x, "y": y, "width": w - 1, "height": h - 1},
+            "area": int(cv2.countNonZero(filled)),
+        }
+        with self._lock:
+            return self._polygons.setdefault(component, info)
+
+    def boundary_points(self, component, max_points=4):
+        """从连通域轮廓上均匀采样引导点"""
+        contour_points = self.contour(component)
+        if len(contour_points) <= max_points:
+            return [[int(p[0]), int(p[1])] for p in contour_points]
+        step = len(contour_points) // max_points
+        return [[int(p[0]), int(p[1])] for p in contour_points[::step][:max_points]]
+
+
+class ColorRegionCache(EmbeddingCache):
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        """按图像哈希缓存 ColorRegionMap，同一图像的多个会话共享"""
+        super().__init__(max_bytes=max_bytes)
+
+    def entry_bytes(self, entry):
+        return entry["regions"].nbytes()
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def compute_image_hash(image_rgb):
+    """基于解码后的像素计算图像哈希（内容寻址键）"""
+    hasher = hashlib.sha1()
+    hasher.update(str(image_rgb.shape).encode("utf-8"))
+    hasher.update(str(image_rgb.dtype).encode("utf-8"))
+    hasher.update(image_rgb.tobytes())
+    return hasher.hexdigest()
+
+
+def capture_predictor_state(predictor):
+    """从SamPredictor中提取图像嵌入及尺寸元数据"""
+    return {
+        "features": predictor.features,
+        "original_size": tuple(predictor.original_size),
+        "input_size": tuple(predictor.input_size),
+    }
+
+
+def restore_predictor_state(predictor, entry):
+    """将缓存的嵌入恢复到SamPredictor，跳过图像编码器"""
+    features = entry["features"]
+    if isinstance(features, np.ndarray):
+        # 内存映射数组是只读的，复制后再交给torch
+        features = torch.from_numpy(np.array(features))
+    predictor.reset_image()
+    predictor.features = features.to(predictor.device)
+    predictor.original_size = tuple(entry["original_size"])
+    predictor.input_size = tuple(entry["input_size"])
+    predictor.is_image_set = True
+
+
+def estimate_entry_bytes(entry):
+    """估算缓存条目占用的内存"""
+    features = entry["features"]
+    if hasattr(features, "element_size"):
+        return int(features.element_size() * features.nelement())
+    return int(features.nbytes)
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        """图像嵌入LRU缓存，按内存预算淘汰最久未使用的条目"""
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """查找缓存条目，命中时移动到最近使用位置"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        """写入缓存条目并按内存预算淘汰"""
+        size = self.entry_bytes(entry)
+        evicted_keys = []
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)["nbytes"]
+            if size > self.max_bytes:
+                # 单个条目超过预算时不缓存
+                return False
+            entry = dict(entry, nbytes=size)
+            self._entries[key] = entry
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted["nbytes"]
+                self.evictions += 1
+                evicted_keys.append(evicted_key)
+        for evicted_key in evicted_keys:
+            self.evicted(evicted_key)
+        return True
+    
+    def evicted(self, key):
+        """条目因内存预算被淘汰后调用（锁外），子类可覆盖以清理关联数据"""
+
+    def entry_bytes(self, entry):
+        """条目占用的内存，子类可按条目类型覆盖"""
+        return estimate_entry_bytes(entry)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """返回命中/未命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+class EmbeddingStore:
+    def __init__(self, root_dir="embedding_store"):
+        """磁盘嵌入存储：按模型类型和图像哈希保存.npy文件，重启后可直接复用"""
+        self.root_dir = root_dir
+
+    def _paths(self, image_hash, model_type):
+        model_dir = os.path.join(self.root_dir, model_type)
+        return (os.path.join(model_dir, f"{image_hash}.npy"),
+                os.path.join(model_dir, f"{image_hash}.json"))
+
+    def has(self, image_hash, model_type):
+        """检查嵌入是否已存在（元数据文件最后写入，存在即表示完整）"""
+        npy_path, meta_path = self._paths(image_hash, model_type)
+        return os.path.exists(meta_path) and os.path.exists(npy_path)
+
+    def load(self, image_hash, model_type):
+        """以内存映射方式加载嵌入，不存在时返回None"""
+        npy_path, meta_path = self._paths(image_hash, model_type)
+        if not self.has(image_hash, model_type):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            features = np.load(npy_path, mmap_mode="r")
+            return {
+                "features": features,
+                "original_size": tuple(meta["original_size"]),
+                "input_size": tuple(meta["input_size"]),
+            }
+        except Exception as e:
+            print(f"嵌入加载失败 ({image_hash[:12]}): {e}")
+            return None
+
+    def save(self, image_hash, model_type, entry):
+        """原子写入嵌入文件（先写临时文件再重命名）"""
+        npy_path, meta_path = self._paths(image_hash, model_type)
+        os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+
+        features = entry["features"]
+        if hasattr(features, "detach"):
+            features = features.detach().cpu().numpy()
+
+        meta = {
+            "model_type": model_type,
+            "original_size": [int(v) for v in entry["original_size"]],
+            "input_size": [int(v) for v in entry["input_size"]],
+            "shape": list(features.shape),
+            "dtype": str(features.dtype),
+        }
+
+        self._atomic_write(npy_path, lambda f: np.save(f, np.ascontiguousarray(features)))
+        self._atomic_write(meta_path, lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    def _atomic_write(self, path, write_fn):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_fn(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
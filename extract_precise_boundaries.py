@@ -1,28 +1,103 @@
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 import json
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from segment_anything import SamAutomaticMaskGenerator, SamPredictor
+from segment_anything.utils.amg import MaskData
+from sam_loader import build_sam
+from mask_encoding import decode_mask
+from simple_mall_segmenter import SimpleMallMapSegmenter
+import argparse
 import os
 
+# Generator settings for store boundaries (also the defaults of the server's /api/jobs)
+PRECISE_GENERATOR_PARAMS = {
+    "points_per_side": 32,
+    "pred_iou_thresh": 0.88,
+    "stability_score_thresh": 0.95,
+    "crop_n_layers": 1,
+    "crop_n_points_downscale_factor": 2,
+    "min_mask_region_area": 1000,  # Filter out small regions
+}
+
+
+def mask_segmentation(mask):
+    """Binary segmentation of a generator record (output_mode binary_mask or uncompressed_rle)"""
+    segmentation = mask['segmentation']
+    if isinstance(segmentation, dict):
+        return decode_mask(segmentation)
+    return segmentation
+
+def store_point_grid(store_mask, grid, fill_missed=True):
+    """Points of a normalized grid that land inside store_mask (the mask of the crop the grid is applied to)
+    
+    With fill_missed, every store area that no grid point hits gets its deepest interior point,
+    so small stores between grid points are still prompted.
+    """
+    height, width = store_mask.shape
+    xs = np.minimum((grid[:, 0] * width).astype(int), width - 1)
+    ys = np.minimum((grid[:, 1] * height).astype(int), height - 1)
+    points = grid[store_mask[ys, xs]]
+    if not fill_missed:
+        return points
+    
+    num_areas, labels = cv2.connectedComponents(store_mask.astype(np.uint8))
+    hit = np.zeros(num_areas, dtype=bool)
+    hit[labels[ys, xs]] = True
+    distance = cv2.distanceTransform(store_mask.astype(np.uint8), cv2.DIST_L2, 3)
+    extra = []
+    for label in np.flatnonzero(~hit[1:]) + 1:
+        area_ys, area_xs = np.nonzero(labels == label)
+        deepest = np.argmax(distance[area_ys, area_xs])
+        extra.append([(area_xs[deepest] + 0.5) / width, (area_ys[deepest] + 0.5) / height])
+    return np.concatenate([points, np.asarray(extra)]) if extra else points
+
+
+class StorePromptMaskGenerator(SamAutomaticMaskGenerator):
+    def __init__(self, model, store_mask, **kwargs):
+        """SamAutomaticMaskGenerator that only prompts inside the colored store areas
+        
+        The generator applies one point grid to every crop of a layer, so the grid of each crop is
+        swapped in through point_grids right before the crop is processed. Crops without any store
+        area are skipped entirely (no encoder run). Store areas missed by the whole-image grid get one
+        interior point each.
+        """
+        super().__init__(model, **kwargs)
+        self.store_mask = store_mask
+        self.uniform_grids = self.point_grids
+        self.prompted_points = 0
+    
+    def _process_crop(self, image, crop_box, crop_layer_idx, orig_size):
+        x0, y0, x1, y1 = crop_box
+        grid = store_point_grid(self.store_mask[y0:y1, x0:x1], self.uniform_grids[crop_layer_idx],
+                                fill_missed=crop_layer_idx == 0)
+        self.prompted_points += len(grid)
+        if len(grid) == 0:
+            return MaskData()
+        
+        self.point_grids = list(self.uniform_grids)
+        self.point_grids[crop_layer_idx] = grid
+        try:
+            return super()._process_crop(image, crop_box, crop_layer_idx, orig_size)
+        finally:
+            self.point_grids = self.uniform_grids
+
+
 class PreciseMallSegmenter:
-    def __init__(self, checkpoint_path="sam_vit_b_01ec64.pth"):
-        """Initialize SAM for precise segmentation"""
+    def __init__(self, checkpoint_path="sam_vit_b_01ec64.pth", quantize_encoder=False, sparse_prompts=False):
+        """Initialize SAM for precise segmentation
+        
+        With sparse_prompts, prompt points are only sampled inside the colored store areas
+        (see StorePromptMaskGenerator) instead of a uniform grid over the whole map.
+        """
         print("Loading SAM model...")
-        self.device = "cpu"  # Use CPU to avoid potential GPU issues
-        sam = sam_model_registry["vit_b"](checkpoint=checkpoint_path)
+        self.device = "cpu"  # Use CPU to avoid potential GPU issues (also required by the int8 encoder)
+        sam = build_sam(checkpoint_path, quantize_encoder=quantize_encoder)
         sam.to(device=self.device)
+        self.sam = sam
+        self.sparse_prompts = sparse_prompts
         
         # Configure mask generator for better results
-        self.mask_generator = SamAutomaticMaskGenerator(
-            model=sam,
-            points_per_side=32,
-            pred_iou_thresh=0.88,
-            stability_score_thresh=0.95,
-            crop_n_layers=1,
-            crop_n_points_downscale_factor=2,
-            min_mask_region_area=1000,  # Filter out small regions
-        )
+        self.mask_generator = SamAutomaticMaskGenerator(model=sam, **PRECISE_GENERATOR_PARAMS)
         
         self.predictor = SamPredictor(sam)
         
@@ -32,13 +107,21 @@ class PreciseMallSegmenter:
         image = cv2.imread(image_path)
         image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         
+        mask_generator = self.mask_generator
+        store_mask = SimpleMallMapSegmenter.store_area_mask(image_rgb) if self.sparse_prompts else None
+        if store_mask is not None and store_mask.any():
+            mask_generator = StorePromptMaskGenerator(self.sam, store_mask, **PRECISE_GENERATOR_PARAMS)
+        
         print("Generating masks with SAM...")
-        masks = self.mask_generator.generate(image_rgb)
+        masks = mask_generator.generate(image_rgb)
+        if mask_generator is not self.mask_generator:
+            print(f"Prompted {mask_generator.prompted_points} points inside store areas")
         
         print(f"Generated {len(masks)} masks")
         return image_rgb, masks
     
-    def analyze_masks(self, image, masks):
+    @classmethod
+    def analyze_masks(cls, image, masks):
         """Analyze and filter masks to identify store areas"""
         height, width = image.shape[:2]
         
@@ -59,7 +142,7 @@ class PreciseMallSegmenter:
                 y > height * 0.05 and y + h < height * 0.95):  # Not on top/bottom edges
                 
                 # Additional shape analysis
-                if self.is_store_like_region(mask, image):
+                if cls.is_store_like_region(mask, image):
                     store_masks.append({
                         'mask': mask,
                         'area': area,
@@ -71,10 +154,11 @@ class PreciseMallSegmenter:
         store_masks = sorted(store_masks, key=lambda x: x['area'], reverse=True)
         return store_masks[:15]  # Keep top 15 candidates
     
-    def is_store_like_region(self, mask, image):
+    @staticmethod
+    def is_store_like_region(mask, image):
         """Check if a mask represents a store-like region"""
         # Get mask data
-        segmentation = mask['segmentation']
+        segmentation = mask_segmentation(mask)
         
         # Find contours
         contours, _ = cv2.findContours(
@@ -106,13 +190,14 @@ class PreciseMallSegmenter:
                 solidity > 0.6 and      # Reasonably filled
                 w > 30 and h > 30)      # Minimum size
     
-    def extract_polygons(self, store_masks):
+    @staticmethod
+    def extract_polygons(store_masks):
         """Extract precise polygon coordinates from masks"""
         polygons = []
         
         for store_mask in store_masks:
             mask = store_mask['mask']
-            segmentation = mask['segmentation']
+            segmentation = mask_segmentation(mask)
             
             # Find contours
             contours, _ = cv2.findContours(
@@ -160,6 +245,8 @@ class PreciseMallSegmenter:
     
     def visualize_results(self, image, polygons, output_path="output/sam_precise_segmentation.png"):
         """Visualize the segmentation results"""
+        import matplotlib.pyplot as plt
+        
         plt.figure(figsize=(15, 10))
         plt.imshow(image)
         plt.axis('off')
@@ -191,8 +278,9 @@ class PreciseMallSegmenter:
         
         print(f"Visualization saved to {output_path}")
     
-    def save_sam_data(self, polygons, image_shape, output_path="output/sam_store_boundaries.json"):
-        """Save the precise SAM results"""
+    @staticmethod
+    def build_sam_data(polygons, image_shape):
+        """Build the region export structure (also returned by the /api/jobs result endpoint)"""
         sam_data = {
             "image_dimensions": {
                 "width": image_shape[1],
@@ -214,6 +302,12 @@ class PreciseMallSegmenter:
             }
             sam_data["regions"].append(region)
         
+        return sam_data
+    
+    def save_sam_data(self, polygons, image_shape, output_path="output/sam_store_boundaries.json"):
+        """Save the precise SAM results"""
+        sam_data = self.build_sam_data(polygons, image_shape)
+        
         # Save to file
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         with open(output_path, 'w', encoding='utf-8') as f:
@@ -225,11 +319,17 @@ class PreciseMallSegmenter:
         return sam_data
 
 def main():
+    parser = argparse.ArgumentParser(description="Extract precise store boundaries with SAM")
+    parser.add_argument("image", nargs="?", default="lumine-yurakucho.png")
+    parser.add_argument("--sparse-prompts", action="store_true",
+                        help="Only prompt inside the colored store areas (far fewer decoder batches)")
+    args = parser.parse_args()
+    
     try:
-        segmenter = PreciseMallSegmenter()
+        segmenter = PreciseMallSegmenter(sparse_prompts=args.sparse_prompts)
         
         # Generate masks
-        image, masks = segmenter.generate_masks("lumine-yurakucho.png")
+        image, masks = segmenter.generate_masks(args.image)
         
         # Analyze and filter masks
         store_masks = segmenter.analyze_masks(image, masks)
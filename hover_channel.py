@@ -0,0 +1,166 @@
+import json
+import threading
+
+import numpy as np
+
+from inference_worker import InferenceQueueFull
+from mask_encoding import encode_mask, mask_to_polygon
+
+
+def prompt_seq(prompt):
+    return int(prompt.get("seq", 0))
+
+
+def valid_seq(prompt):
+    """seq缺省为0，否则必须是整数（bool除外）"""
+    seq = prompt.get("seq", 0)
+    return isinstance(seq, int) and not isinstance(seq, bool)
+
+
+class LatestPromptSlot:
+    def __init__(self):
+        """只保留最新提示的单槽信箱：新提示直接覆盖尚未处理的旧提示"""
+        self.dropped = 0
+        self._prompt = None
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, prompt):
+        """写入提示；比槽中提示更旧（seq更小）的乱序提示直接丢弃"""
+        with self._cond:
+            if self._prompt is not None:
+                self.dropped += 1
+                if prompt_seq(prompt) < prompt_seq(self._prompt):
+                    return
+            self._prompt = prompt
+            self._cond.notify()
+
+    def take(self):
+        """阻塞直到有新提示，连接关闭后返回None"""
+        with self._cond:
+            while self._prompt is None and not self._closed:
+                self._cond.wait()
+            prompt, self._prompt = self._prompt, None
+            return prompt
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+
+def color_hover_result(server, prompt):
+    """mode=color：由预先计算的色块回答，光标不在任何色块上时返回None（改用SAM解码）"""
+    session = server.sessions.get(prompt.get("session_id") or server.default_session_id)
+    if session is None or session.color_regions is None:
+        return None
+    components = server.color_components(session.color_regions, prompt.get("points") or None,
+                                         prompt.get("point_labels") or None, prompt.get("boxes") or None)
+    if not components:
+        return None
+    output_format = prompt.get("format", "polygon")
+    result = server.color_result(session.color_regions, components, mask_encoding="rle",
+                                 output_format=output_format)
+    best = result["masks"][0]
+    hover = {"seq": prompt_seq(prompt), "success": True, "score": best["score"], "format": output_format,
+             "mode": "color", "shape": result["shape"]}
+    if output_format == "polygon":
+        hover.update({key: best[key] for key in ("polygon", "center", "bbox", "area")})
+    else:
+        hover.update({"mask": best["mask"], "mask_encoding": "rle", "area": best["area"]})
+    return hover
+
+
+def hover_result(server, prompt):
+    """对单个悬停提示解码，只返回最佳掩码（RLE或多边形），不修改会话的点击提示
+
+    "mode": "color" 时优先查色块（亚毫秒级），光标不在纯色色块上时回退到SAM解码。
+    """
+    seq = prompt_seq(prompt)
+    if prompt.get("mode") == "color":
+        result = color_hover_result(server, prompt)
+        if result is not None:
+            return result
+    output_format = prompt.get("format", "polygon")
+    success, message, decoded = server.predict_masks(
+        points=prompt.get("points") or None,
+        point_labels=prompt.get("point_labels") or None,
+        boxes=prompt.get("boxes") or None,
+        session_id=prompt.get("session_id"),
+        record_prompt=False
+    )
+    if not success:
+        return {"seq": seq, "success": False, "message": message}
+
+    masks, scores = decoded
+    best_idx = int(np.argmax(scores))
+    best_mask = masks[best_idx] > 0
+    result = {"seq": seq, "success": True, "score": float(scores[best_idx]), "format": output_format,
+              "shape": [int(best_mask.shape[0]), int(best_mask.shape[1])]}
+    if output_format == "polygon":
+        result.update(mask_to_polygon(best_mask) or {"polygon": [], "center": None, "bbox": None, "area": 0})
+    else:
+        result.update({"mask": encode_mask(best_mask, "rle"), "mask_encoding": "rle",
+                       "area": int(np.count_nonzero(best_mask))})
+    return result
+
+
+def run_hover_channel(ws, server):
+    """悬停预览WebSocket会话
+
+    读线程持续接收带seq的提示并写入单槽信箱；本线程每次只取最新的提示解码，
+    解码期间到达的旧提示被覆盖丢弃，seq不大于已处理值的乱序提示直接忽略。
+    """
+    slot = LatestPromptSlot()
+    # 读线程也会回复格式错误的提示，两个线程的发送需要串行
+    send_lock = threading.Lock()
+
+    def send(result):
+        with send_lock:
+            ws.send(json.dumps(result))
+
+    def receive_prompts():
+        try:
+            while True:
+                message = ws.receive()
+                if message is None:
+                    break
+                try:
+                    prompt = json.loads(message)
+                except ValueError:
+                    continue
+                if not isinstance(prompt, dict):
+                    continue
+                if not valid_seq(prompt):
+                    # 格式错误的提示不进入信箱，避免在主循环中出错
+                    send({"seq": None, "success": False, "message": "seq must be an integer"})
+                    continue
+                slot.put(prompt)
+        except Exception:
+            pass
+        finally:
+            slot.close()
+
+    threading.Thread(target=receive_prompts, name="sam-hover-reader", daemon=True).start()
+
+    last_seq = -1
+    while True:
+        prompt = slot.take()
+        if prompt is None:
+            break
+        seq = prompt_seq(prompt)
+        if seq <= last_seq:
+            continue
+        last_seq = seq
+
+        try:
+            result = hover_result(server, prompt)
+        except InferenceQueueFull as e:
+            result = {"seq": seq, "success": False, "message": str(e), "retry": True}
+        except Exception as e:
+            result = {"seq": seq, "success": False, "message": str(e)}
+        result["dropped"] = slot.dropped
+        try:
+            send(result)
+        except Exception:
+            break
@@ -0,0 +1,88 @@
+import hashlib
+import threading
+
+import cv2
+import numpy as np
+
+from embedding_cache import EmbeddingCache, compute_image_hash
+
+
+def compute_bytes_hash(data):
+    """上传原始字节的哈希，用于在解码前识别重复上传"""
+    return hashlib.sha1(data).hexdigest()
+
+
+def decode_image_bytes(data):
+    """解码PNG/JPEG等图像字节为RGB数组"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Cannot decode image data")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class ImageRegistry(EmbeddingCache):
+    def __init__(self, max_bytes=512 * 1024 * 1024, on_evict=None):
+        """已上传图像的LRU注册表：image_id（像素哈希）-> 解码后的RGB图像
+
+        另记录原始字节哈希到image_id的映射，相同文件再次上传时无需解码。
+        图像被淘汰时一并删除其别名，并调用 on_evict(image_id) 清理外部的关联数据。
+        """
+        super().__init__(max_bytes=max_bytes)
+        self.on_evict = on_evict
+        self._aliases = {}
+        self._alias_lock = threading.Lock()
+
+    def entry_bytes(self, entry):
+        return int(entry["image"].nbytes)
+
+    def evicted(self, image_id):
+        with self._alias_lock:
+            for bytes_hash in [h for h, alias in self._aliases.items() if alias == image_id]:
+                del self._aliases[bytes_hash]
+        if self.on_evict is not None:
+            self.on_evict(image_id)
+
+    def stats(self):
+        stats = super().stats()
+        with self._alias_lock:
+            stats["aliases"] = len(self._aliases)
+        return stats
+
+    def lookup_bytes(self, bytes_hash):
+        """按原始字节哈希查找已注册图像，返回 (image_id, image_rgb)，未命中返回None"""
+        with self._alias_lock:
+            image_id = self._aliases.get(bytes_hash)
+        if image_id is None:
+            return None
+        entry = self.get(image_id)
+        if entry is None:
+            # 图像已被淘汰，别名失效
+            with self._alias_lock:
+                self._aliases.pop(bytes_hash, None)
+            return None
+        return image_id, entry["image"]
+
+    def register(self, data, bytes_hash=None):
+        """注册上传的图像字节，返回 (image_id, image_rgb, deduplicated)"""
+        bytes_hash = bytes_hash or compute_bytes_hash(data)
+        found = self.lookup_bytes(bytes_hash)
+        if found is not None:
+            return found[0], found[1], True
+
+        image_rgb = decode_image_bytes(data)
+        image_id = compute_image_hash(image_rgb)
+        # 不同编码（如重新压缩的PNG）解码出相同像素时复用已有图像
+        entry = self.get(image_id)
+        deduplicated = entry is not None
+        if deduplicated:
+            image_rgb = entry["image"]
+        else:
+            self.put(image_id, {"image": image_rgb})
+        with self._alias_lock:
+            self._aliases[bytes_hash] = image_id
+        return image_id, image_rgb, deduplicated
+
+    def image(self, image_id):
+        """按image_id获取已注册的图像，不存在或已淘汰时返回None"""
+        entry = self.get(image_id)
+        return entry["image"] if entry is not None else None
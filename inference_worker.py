@@ -0,0 +1,275 @@
+import collections
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+class InferenceQueueFull(Exception):
+    """推理队列已满，调用方应返回503让客户端稍后重试"""
+
+
+class PendingJob:
+    def __init__(self, fn, args, kwargs):
+        """在推理线程上执行的任意模型任务（如图像编码）"""
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.background = False
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+# 后台任务入队时放入主队列的唤醒标记
+_WAKE = object()
+
+
+class PendingPrediction:
+    def __init__(self, session, points, point_labels, boxes, mask_input=None, multimask_output=True):
+        """等待批量解码的单个预测请求"""
+        self.session = session
+        self.points = points
+        self.point_labels = point_labels
+        self.boxes = boxes
+        self.mask_input = mask_input
+        self.multimask_output = multimask_output
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def group_key(self):
+        """同一嵌入、同形状提示的请求可以合并到一次解码
+
+        点数也要一致：用非点标签填充会改变解码器的注意力输入，结果与单独预测不同。
+        """
+        return (self.session.image_hash, len(self.points or []), bool(self.boxes),
+                self.mask_input is not None, self.multimask_output)
+
+
+class InferenceWorker:
+    def __init__(self, server, max_wait_ms=5, max_batch=8, max_queue=64, metrics=None):
+        """专用推理线程：独占模型，所有编码/解码任务经有界队列提交
+
+        解码请求会短暂等待以收集并发请求，合并为一次批量解码（max_batch<=1时不合并）。
+        后台任务（如自动掩码生成的各个步骤）单独排队，只在没有交互请求时执行。
+        """
+        self.server = server
+        self.metrics = metrics
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.max_queue = max_queue
+        self.batches = 0
+        self.batched_requests = 0
+        self.jobs = 0
+        self.background_jobs = 0
+        self.rejected = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._background = collections.deque()
+        self._worker = threading.Thread(target=self._run, name="sam-inference-worker", daemon=True)
+        self._worker.start()
+
+    def _enqueue(self, item):
+        item.enqueued_at = time.perf_counter()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.rejected += 1
+            raise InferenceQueueFull(f"Inference queue is full ({self.max_queue} pending requests)")
+
+    def _observe_queue_wait(self, item):
+        """记录任务从入队到开始执行的等待时间"""
+        if self.metrics is not None:
+            self.metrics.observe("inference_worker", "queue_wait", time.perf_counter() - item.enqueued_at)
+
+    def queue_depth(self):
+        """当前排队的任务数"""
+        return self._queue.qsize()
+
+    def run_job(self, fn, *args, **kwargs):
+        """在推理线程上执行任务并阻塞等待结果"""
+        job = PendingJob(fn, args, kwargs)
+        self._enqueue(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def run_background(self, fn, *args, **kwargs):
+        """以低优先级在推理线程上执行任务并阻塞等待结果
+
+        不受队列上限限制；推理线程每处理完一个交互任务都会先检查主队列，
+        后台任务只在主队列为空时逐个执行，因此应拆成较小的步骤提交。
+        """
+        job = PendingJob(fn, args, kwargs)
+        job.background = True
+        self._background.append(job)
+        # 唤醒可能阻塞在主队列上的推理线程（主队列满时推理线程正忙，稍后自然会检查后台队列）
+        try:
+            self._queue.put_nowait(_WAKE)
+        except queue.Full:
+            pass
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _next_item(self):
+        """优先取交互任务；主队列为空时取一个后台任务，都没有时阻塞等待"""
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._background.popleft()
+        except IndexError:
+            return self._queue.get()
+
+    def accepts(self, boxes):
+        """多框请求由预测器逐个处理，不参与合并"""
+        return not boxes or len(boxes) == 1
+
+    def submit(self, session, points, point_labels, boxes, mask_input=None, multimask_output=True):
+        """提交请求并阻塞等待结果，返回 (masks, scores, logits)"""
+        if points and (not point_labels or len(point_labels) != len(points)):
+            # 提前校验，避免一个错误请求导致同组的其他请求一起失败
+            raise ValueError("point_labels must be supplied for every point")
+        pending = PendingPrediction(session, points, point_labels, boxes, mask_input, multimask_output)
+        self._enqueue(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _run(self):
+        while True:
+            item = self._next_item()
+            if item is _WAKE:
+                continue
+            if isinstance(item, PendingJob) and item.background:
+                item.run()
+                self.background_jobs += 1
+                continue
+            if isinstance(item, PendingJob):
+                self._observe_queue_wait(item)
+                item.run()
+                self.jobs += 1
+                continue
+
+            # 收集窗口内的解码请求；期间到达的其他任务在本批之后按顺序执行
+            batch = [item]
+            deferred_jobs = []
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    next_item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if next_item is _WAKE:
+                    continue
+                if isinstance(next_item, PendingJob):
+                    deferred_jobs.append(next_item)
+                else:
+                    batch.append(next_item)
+
+            self._process_batch(batch)
+
+            for job in deferred_jobs:
+                self._observe_queue_wait(job)
+                job.run()
+                self.jobs += 1
+
+    def _process_batch(self, batch):
+        groups = {}
+        for pending in batch:
+            self._observe_queue_wait(pending)
+            groups.setdefault(pending.group_key(), []).append(pending)
+
+        for items in groups.values():
+            try:
+                results = self._decode_group(items)
+                for pending, result in zip(items, results):
+                    pending.result = result
+            except Exception as e:
+                for pending in items:
+                    pending.error = e
+            finally:
+                for pending in items:
+                    pending.done.set()
+
+        self.batches += 1
+        self.batched_requests += len(batch)
+
+    def _decode_group(self, items):
+        """对共享同一嵌入的一组请求执行一次 predict_torch"""
+        predictor = self.server.predictor
+        batch_size = len(items)
+
+        coords = labels = None
+        if items[0].points:
+            coords = np.array([item.points for item in items], dtype=np.float32)
+            labels = np.array([item.point_labels for item in items])
+
+        boxes = None
+        if items[0].boxes:
+            boxes = np.array([item.boxes[0] for item in items], dtype=np.float32)
+
+        mask_input = None
+        if items[0].mask_input is not None:
+            mask_input = np.stack([item.mask_input for item in items]).astype(np.float32)
+
+        with self.server.model_lock:
+            self.server.activate_session(items[0].session)
+            coords_torch = labels_torch = boxes_torch = mask_input_torch = None
+            if coords is not None:
+                coords = predictor.transform.apply_coords(coords, predictor.original_size)
+                coords_torch = torch.as_tensor(coords, dtype=torch.float, device=predictor.device)
+                labels_torch = torch.as_tensor(labels, dtype=torch.int, device=predictor.device)
+            if boxes is not None:
+                boxes = predictor.transform.apply_boxes(boxes, predictor.original_size)
+                boxes_torch = torch.as_tensor(boxes, dtype=torch.float, device=predictor.device)
+            if mask_input is not None:
+                mask_input_torch = torch.as_tensor(mask_input, device=predictor.device)
+
+            masks, iou_predictions, low_res_masks = predictor.predict_torch(
+                coords_torch,
+                labels_torch,
+                boxes_torch,
+                mask_input_torch,
+                multimask_output=items[0].multimask_output,
+                return_logits=True
+            )
+
+        masks = masks.detach().cpu().numpy()
+        iou_predictions = iou_predictions.detach().cpu().numpy()
+        low_res_masks = low_res_masks.detach().cpu().numpy()
+        return [(masks[i], iou_predictions[i], low_res_masks[i]) for i in range(batch_size)]
+
+    def stats(self):
+        """返回队列及合并统计"""
+        return {
+            "queue_depth": self.queue_depth(),
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "jobs": self.jobs,
+            "background_jobs": self.background_jobs,
+            "background_queue": len(self._background),
+            "max_wait_ms": self.max_wait * 1000.0,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "requests": self.batched_requests,
+            "avg_batch_size": (self.batched_requests / self.batches) if self.batches else 0.0,
+        }
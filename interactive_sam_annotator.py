@@ -6,18 +6,31 @@ import tkinter as tk
 from tkinter import messagebox, simpledialog
 from PIL import Image, ImageTk
 from segment_anything import sam_model_registry, SamPredictor
+from mask_encoding import mask_to_polygon
+from embedding_cache import EmbeddingStore, compute_image_hash, capture_predictor_state, restore_predictor_state
 
 class InteractiveSAMAnnotator:
-    def __init__(self, image_path, checkpoint_path="sam_vit_b_01ec64.pth"):
+    def __init__(self, image_path, checkpoint_path="sam_vit_b_01ec64.pth", store_dir="embedding_store"):
         """交互式SAM标注工具"""
         print("Loading SAM model...")
-        self.sam = sam_model_registry["vit_b"](checkpoint=checkpoint_path)
+        self.model_type = "vit_b"
+        self.sam = sam_model_registry[self.model_type](checkpoint=checkpoint_path)
         self.predictor = SamPredictor(self.sam)
         
         # 加载图像
         self.image = cv2.imread(image_path)
         self.image_rgb = cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
-        self.predictor.set_image(self.image_rgb)
+        
+        # 优先从磁盘嵌入存储恢复，避免重新运行图像编码器
+        embedding_store = EmbeddingStore(store_dir)
+        image_hash = compute_image_hash(self.image_rgb)
+        stored = embedding_store.load(image_hash, self.model_type)
+        if stored is not None:
+            restore_predictor_state(self.predictor, stored)
+            print("Restored image embedding from store")
+        else:
+            self.predictor.set_image(self.image_rgb)
+            embedding_store.save(image_hash, self.model_type, capture_predictor_state(self.predictor))
         
         # 标注数据
         self.annotations = []
@@ -292,53 +305,31 @@ class InteractiveSAMAnnotator:
         mask = self.temp_mask
         
         # 计算边界框和多边形
-        y_indices, x_indices = np.where(mask)
-        if len(x_indices) > 0:
-            x1, x2 = int(np.min(x_indices)), int(np.max(x_indices))
-            y1, y2 = int(np.min(y_indices)), int(np.max(y_indices))
+        shape_info = mask_to_polygon(mask)
+        if shape_info is not None:
+            # 创建标注数据
+            annotation = {
+                "id": f"store_{len(self.annotations)}",
+                "name": store_name,
+                "category": category,
+                "color": self.get_category_color(category),
+                "bbox": shape_info["bbox"],
+                "polygon": shape_info["polygon"],
+                "center": shape_info["center"],
+                "area": shape_info["area"],
+                "mask": mask
+            }
+            
+            self.annotations.append(annotation)
+            
+            # 清除当前输入
+            self.clear_current()
+            
+            # 更新计数
+            self.count_label.config(text=f"已标注店铺: {len(self.annotations)}")
+            
+            messagebox.showinfo("成功", f"店铺 '{store_name}' 标注完成！")
             
-            # 提取轮廓
-            contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            if contours:
-                largest_contour = max(contours, key=cv2.contourArea)
-                
-                # 简化轮廓
-                epsilon = 0.005 * cv2.arcLength(largest_contour, True)
-                approx = cv2.approxPolyDP(largest_contour, epsilon, True)
-                
-                polygon = [{"x": int(point[0][0]), "y": int(point[0][1])} for point in approx]
-                
-                # 计算中心点
-                M = cv2.moments(largest_contour)
-                if M["m00"] != 0:
-                    cx = int(M["m10"] / M["m00"])
-                    cy = int(M["m01"] / M["m00"])
-                else:
-                    cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
-                
-                # 创建标注数据
-                annotation = {
-                    "id": f"store_{len(self.annotations)}",
-                    "name": store_name,
-                    "category": category,
-                    "color": self.get_category_color(category),
-                    "bbox": {"x": x1, "y": y1, "width": x2-x1, "height": y2-y1},
-                    "polygon": polygon,
-                    "center": {"x": cx, "y": cy},
-                    "area": int(np.sum(mask)),
-                    "mask": mask
-                }
-                
-                self.annotations.append(annotation)
-                
-                # 清除当前输入
-                self.clear_current()
-                
-                # 更新计数
-                self.count_label.config(text=f"已标注店铺: {len(self.annotations)}")
-                
-                messagebox.showinfo("成功", f"店铺 '{store_name}' 标注完成！")
-                
     def get_category_color(self, category):
         """获取类别颜色"""
         colors = {
@@ -0,0 +1,95 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# 覆盖解码（毫秒级）到CPU图像编码（数十秒至分钟级）的直方图桶，单位秒
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """累积直方图（Prometheus语义：每个桶统计 <= 上界的样本数）"""
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, upper in enumerate(self.buckets):
+            if seconds <= upper:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+class RequestTimings:
+    def __init__(self):
+        """单个请求内各阶段耗时，同名阶段多次计时会累加"""
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        """计时上下文：with timings.stage("decoder"): ..."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self, total=None):
+        """生成Server-Timing响应头（毫秒）"""
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        if total is not None:
+            entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+
+class LatencyMetrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """按 (接口, 阶段) 聚合的延迟直方图，输出Prometheus文本格式"""
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get((endpoint, stage))
+            if histogram is None:
+                histogram = self._histograms[(endpoint, stage)] = LatencyHistogram(self.buckets)
+            histogram.observe(seconds)
+
+    def observe_request(self, endpoint, timings, total):
+        """记录一个请求的全部阶段及HTTP总耗时"""
+        for stage, seconds in timings.stages.items():
+            self.observe(endpoint, stage, seconds)
+        self.observe(endpoint, "http_total", total)
+
+    def render_prometheus(self, gauges=None, counters=None):
+        """Prometheus文本格式；gauges/counters为 {指标名: (说明, 数值)} 的附加瞬时值/单调递增计数（名称以_total结尾）"""
+        lines = [
+            "# HELP sam_stage_duration_seconds Latency of SAM API request stages",
+            "# TYPE sam_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for (endpoint, stage), histogram in sorted(self._histograms.items()):
+                labels = f'endpoint="{endpoint}",stage="{stage}"'
+                for upper, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'sam_stage_duration_seconds_bucket{{{labels},le="{upper:g}"}} {count}')
+                lines.append(f'sam_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"sam_stage_duration_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+                lines.append(f"sam_stage_duration_seconds_count{{{labels}}} {histogram.count}")
+
+        for metric_type, metrics in (("gauge", gauges), ("counter", counters)):
+            for name, (help_text, value) in (metrics or {}).items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,103 @@
+import base64
+
+import cv2
+import numpy as np
+
+MASK_ENCODINGS = ("raw", "rle", "bitpack")
+OUTPUT_FORMATS = ("mask", "polygon")
+
+
+def encode_mask_rle(mask):
+    """COCO风格的非压缩RLE（列优先），counts从背景游程开始"""
+    mask = np.asarray(mask)
+    height, width = mask.shape[:2]
+    pixels = (mask > 0).ravel(order='F')
+    if pixels.size == 0:
+        return {"size": [int(height), int(width)], "counts": []}
+
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    boundaries = np.concatenate(([0], changes, [pixels.size]))
+    counts = np.diff(boundaries)
+    if pixels[0]:
+        counts = np.concatenate(([0], counts))
+    return {"size": [int(height), int(width)], "counts": counts.tolist()}
+
+
+def decode_mask_rle(rle):
+    """解码COCO风格RLE为bool掩码"""
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    pixels = np.repeat(values, counts)
+    return pixels.reshape((height, width), order='F')
+
+
+def encode_mask_bitpacked(mask):
+    """行优先位打包（np.packbits）后base64编码"""
+    mask = np.asarray(mask)
+    packed = np.packbits((mask > 0).ravel())
+    return {
+        "shape": [int(mask.shape[0]), int(mask.shape[1])],
+        "data": base64.b64encode(packed.tobytes()).decode("ascii"),
+    }
+
+
+def decode_mask_bitpacked(payload):
+    """解码位打包掩码为bool掩码"""
+    height, width = payload["shape"]
+    packed = np.frombuffer(base64.b64decode(payload["data"]), dtype=np.uint8)
+    return np.unpackbits(packed, count=height * width).astype(bool).reshape(height, width)
+
+
+def encode_mask(mask, encoding="raw"):
+    """按指定方式编码掩码；raw为兼容旧客户端的0/255嵌套列表"""
+    if encoding == "rle":
+        return encode_mask_rle(mask)
+    if encoding == "bitpack":
+        return encode_mask_bitpacked(mask)
+    if encoding == "raw":
+        return ((np.asarray(mask) > 0).astype(np.uint8) * 255).tolist()
+    raise ValueError(f"Unknown mask encoding: {encoding}")
+
+
+def decode_mask(payload):
+    """解码任意编码的掩码为bool掩码"""
+    if isinstance(payload, dict):
+        if "counts" in payload:
+            return decode_mask_rle(payload)
+        return decode_mask_bitpacked(payload)
+    return np.array(payload, dtype=np.uint8) > 0
+
+
+def mask_to_polygon(mask, epsilon_ratio=0.005):
+    """提取最大轮廓的简化多边形、中心点、边界框和面积，空掩码返回None"""
+    mask_uint8 = (np.asarray(mask) > 0).astype(np.uint8)
+    nonzero = cv2.findNonZero(mask_uint8)
+    if nonzero is None:
+        return None
+
+    x, y, w, h = cv2.boundingRect(nonzero)
+
+    contours, _ = cv2.findContours(mask_uint8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    largest_contour = max(contours, key=cv2.contourArea)
+
+    # 简化轮廓
+    epsilon = epsilon_ratio * cv2.arcLength(largest_contour, True)
+    approx = cv2.approxPolyDP(largest_contour, epsilon, True)
+    polygon = [{"x": int(point[0][0]), "y": int(point[0][1])} for point in approx]
+
+    # 计算中心点
+    M = cv2.moments(largest_contour)
+    if M["m00"] != 0:
+        cx = int(M["m10"] / M["m00"])
+        cy = int(M["m01"] / M["m00"])
+    else:
+        cx, cy = x + (w - 1) // 2, y + (h - 1) // 2
+
+    return {
+        "polygon": polygon,
+        "center": {"x": cx, "y": cy},
+        "bbox": {"x": x, "y": y, "width": w - 1, "height": h - 1},
+        "area": int(cv2.countNonZero(mask_uint8)),
+    }
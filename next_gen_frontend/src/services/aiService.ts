@@ -19,10 +19,15 @@ interface PredictionResponse extends SAMPrediction {
  */
 export class AIAssistant {
   private apiEndpoint: string;
+  // SAM API服务器（sam_api_server.py）的路由，vite开发服务器把 /api 原样代理到 :5000
+  private samEndpoint: string;
   private modelVersion: string;
+  // 已上传图像的image_id，同一ImageData只上传一次
+  private imageIds = new WeakMap<ImageData, Promise<string>>();
   
   constructor() {
     this.apiEndpoint = '/api/sam';
+    this.samEndpoint = '/api';
     this.modelVersion = '1.0.0';
   }
 
@@ -30,16 +35,17 @@ export class AIAssistant {
    * SAM图像分割预测
    */
   async predictSegmentation(request: PredictionRequest): Promise<PredictionResponse> {
-    const response = await fetch(`${this.apiEndpoint}/predict`, {
+    const imageId = await this.uploadImage(request.imageData);
+    const response = await fetch(`${this.samEndpoint}/predict`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
       },
       body: JSON.stringify({
-        image_data: this.imageDataToBase64(request.imageData),
+        image_id: imageId,
         points: [[request.point.x, request.point.y]],
         point_labels: [1],
-        box: request.box,
+        boxes: request.box ? [request.box] : [],
         model_version: this.modelVersion
       })
     });
@@ -57,6 +63,20 @@ export class AIAssistant {
     return this.processSAMResult(result);
   }
 
+  /**
+   * 上传图像原始字节，返回服务端的image_id（服务端按内容去重，已编码的图像直接复用嵌入）
+   */
+  async uploadImage(imageData: ImageData): Promise<string> {
+    let imageId = this.imageIds.get(imageData);
+    if (!imageId) {
+      imageId = this.postImage(imageData);
+      this.imageIds.set(imageData, imageId);
+      // 上传失败时允许下次重试
+      imageId.catch(() => this.imageIds.delete(imageData));
+    }
+    return imageId;
+  }
+
   /**
    * 智能区域分析
    */
@@ -135,13 +155,31 @@ export class AIAssistant {
 
   // 私有辅助方法
 
-  private imageDataToBase64(imageData: ImageData): string {
+  private async postImage(imageData: ImageData): Promise<string> {
+    const response = await fetch(`${this.samEndpoint}/images`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'image/png',
+      },
+      body: await this.imageDataToBlob(imageData)
+    });
+
+    const result = await response.json();
+    if (!response.ok || !result.success) {
+      throw new Error(result.message || `Image upload failed: ${response.statusText}`);
+    }
+    return result.image_id;
+  }
+
+  private imageDataToBlob(imageData: ImageData): Promise<Blob> {
     const canvas = document.createElement('canvas');
     const ctx = canvas.getContext('2d')!;
     canvas.width = imageData.width;
     canvas.height = imageData.height;
     ctx.putImageData(imageData, 0, 0);
-    return canvas.toDataURL('image/png');
+    return new Promise((resolve, reject) => {
+      canvas.toBlob(blob => blob ? resolve(blob) : reject(new Error('Failed to encode image')), 'image/png');
+    });
   }
 
   private processSAMResult(result: any): PredictionResponse {
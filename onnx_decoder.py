@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+import torch
+from segment_anything.utils.onnx import SamOnnxModel
+from segment_anything.utils.transforms import ResizeLongestSide
+
+try:
+    import onnxruntime
+except ImportError:  # onnxruntime为可选依赖，缺失时回退到PyTorch解码器
+    onnxruntime = None
+
+
+def onnx_path_for_checkpoint(checkpoint_path):
+    """ONNX解码器缓存文件放在checkpoint旁边"""
+    base = os.path.splitext(checkpoint_path or "sam_vit_b")[0]
+    return f"{base}_decoder.onnx"
+
+
+class LowResSamOnnxModel(SamOnnxModel):
+    """只输出低分辨率掩码的导出模型
+
+    官方模型在图中做上采样，但追踪时会把裁剪尺寸固化为示例输入的宽高比，
+    对其他比例的楼层图结果错误，因此上采样留在导出模型之外完成。
+    """
+
+    @torch.no_grad()
+    def forward(self, image_embeddings, point_coords, point_labels, mask_input, has_mask_input):
+        sparse_embedding = self._embed_points(point_coords, point_labels)
+        dense_embedding = self._embed_masks(mask_input, has_mask_input)
+
+        masks, scores = self.model.mask_decoder.predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=self.model.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embedding,
+            dense_prompt_embeddings=dense_embedding,
+        )
+        return scores, masks
+
+
+def export_decoder_onnx(sam, output_path, opset_version=17):
+    """导出提示编码器+掩码解码器为ONNX（参考官方export_onnx_model脚本）"""
+    onnx_model = LowResSamOnnxModel(sam, return_single_mask=False)
+
+    embed_dim = sam.prompt_encoder.embed_dim
+    embed_size = sam.prompt_encoder.image_embedding_size
+    mask_input_size = [4 * x for x in embed_size]
+    dummy_inputs = {
+        "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+        "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+        "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
+        "has_mask_input": torch.tensor([1], dtype=torch.float),
+    }
+    dynamic_axes = {
+        "point_coords": {1: "num_points"},
+        "point_labels": {1: "num_points"},
+    }
+
+    # 先写临时文件再重命名，避免并发启动时读到不完整的模型
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    export_kwargs = dict(
+        export_params=True,
+        verbose=False,
+        opset_version=opset_version,
+        do_constant_folding=True,
+        input_names=list(dummy_inputs.keys()),
+        output_names=["iou_predictions", "low_res_masks"],
+        dynamic_axes=dynamic_axes,
+    )
+    try:
+        torch.onnx.export(onnx_model, tuple(dummy_inputs.values()), tmp_path, dynamo=False, **export_kwargs)
+    except TypeError:
+        # 旧版torch没有dynamo参数
+        torch.onnx.export(onnx_model, tuple(dummy_inputs.values()), tmp_path, **export_kwargs)
+    os.replace(tmp_path, output_path)
+
+
+class OnnxMaskDecoder:
+    def __init__(self, sam, checkpoint_path, num_threads=None):
+        """基于onnxruntime的提示编码器+掩码解码器，直接使用缓存的图像嵌入"""
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is not installed")
+
+        self.onnx_path = onnx_path_for_checkpoint(checkpoint_path)
+        if not os.path.exists(self.onnx_path):
+            print(f"Exporting SAM decoder to {self.onnx_path}...")
+            export_decoder_onnx(sam, self.onnx_path)
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            self.onnx_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.sam = sam
+        self.transform = ResizeLongestSide(sam.image_encoder.img_size)
+        self.mask_input_size = [4 * x for x in sam.prompt_encoder.image_embedding_size]
+
+    def _features_numpy(self, embedding):
+        features = embedding["features"]
+        if isinstance(features, np.ndarray):
+            return np.ascontiguousarray(features, dtype=np.float32)
+        return features.detach().cpu().numpy()
+
+    def predict(self, embedding, point_coords=None, point_labels=None, box=None, mask_input=None,
+                multimask_output=True):
+        """与SamPredictor.predict相同的输入输出（logits），但不依赖预测器当前图像"""
+        original_size = tuple(embedding["original_size"])
+
+        coords = np.zeros((0, 2), dtype=np.float32)
+        labels = np.zeros((0,), dtype=np.float32)
+        if point_coords is not None:
+            coords = np.asarray(point_coords, dtype=np.float32).reshape(-1, 2)
+            labels = np.asarray(point_labels, dtype=np.float32).reshape(-1)
+        if box is not None:
+            # 框编码为两个角点，标签2/3
+            box = np.asarray(box, dtype=np.float32).reshape(-1, 4)[0]
+            coords = np.concatenate([coords, box.reshape(2, 2)], axis=0)
+            labels = np.concatenate([labels, np.array([2, 3], dtype=np.float32)])
+        else:
+            # 没有框时补一个非点，与PromptEncoder的填充一致
+            coords = np.concatenate([coords, np.zeros((1, 2), dtype=np.float32)], axis=0)
+            labels = np.concatenate([labels, np.array([-1], dtype=np.float32)])
+
+        coords = self.transform.apply_coords(coords, original_size).astype(np.float32)
+
+        if mask_input is not None:
+            onnx_mask_input = np.asarray(mask_input, dtype=np.float32).reshape(1, 1, *self.mask_input_size)
+            has_mask_input = np.ones(1, dtype=np.float32)
+        else:
+            onnx_mask_input = np.zeros((1, 1, *self.mask_input_size), dtype=np.float32)
+            has_mask_input = np.zeros(1, dtype=np.float32)
+
+        iou_predictions, low_res_masks = self.session.run(None, {
+            "image_embeddings": self._features_numpy(embedding),
+            "point_coords": coords[None, :, :],
+            "point_labels": labels[None, :],
+            "mask_input": onnx_mask_input,
+            "has_mask_input": has_mask_input,
+        })
+
+        # 导出的模型返回全部4个mask token：0为单掩码输出，1-3为多掩码输出
+        selected = slice(1, None) if multimask_output else slice(0, 1)
+        low_res_masks = low_res_masks[:, selected]
+        with torch.no_grad():
+            masks = self.sam.postprocess_masks(
+                torch.from_numpy(low_res_masks), tuple(embedding["input_size"]), original_size
+            )
+        return masks[0].numpy(), iou_predictions[0, selected], low_res_masks[0]
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+批量预编码楼层图：多进程并行运行图像编码器，把嵌入写入服务端的嵌入存储
+
+已存在的嵌入按像素哈希跳过，中断后重新运行即可从未完成的图像继续。
+用法: python precompute_embeddings.py maps/ --workers 4
+"""
+
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+
+import cv2
+import numpy as np
+
+from embedding_cache import EmbeddingStore, compute_image_hash, capture_predictor_state
+from sam_loader import embedding_variant
+from tiled_encoding import TiledImage, TILE_SIZE, TILE_OVERLAP
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+# 工作进程内的模型，由 init_worker 加载一次
+_predictor = None
+_store = None
+_variant = None
+
+
+def find_images(directory, recursive=True):
+    """列出目录下的图像文件（按路径排序，保证多次运行顺序一致）"""
+    pattern = os.path.join(directory, "**", "*") if recursive else os.path.join(directory, "*")
+    return sorted(path for path in glob.glob(pattern, recursive=recursive)
+                  if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def read_image_rgb(image_path):
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Cannot read image: {image_path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def plan_units(image_path, tile_threshold=2048, tile_size=TILE_SIZE, tile_overlap=TILE_OVERLAP):
+    """一张图像需要编码的单元 [(瓦片范围或None, 哈希)]，与服务端set_image的切分规则一致"""
+    image_rgb = read_image_rgb(image_path)
+    if max(image_rgb.shape[:2]) <= tile_threshold:
+        return [(None, compute_image_hash(image_rgb))]
+
+    tiled = TiledImage(image_rgb, tile_size=tile_size, overlap=tile_overlap)
+    units = []
+    for tile in tiled.tiles:
+        bounds = (tile.y0, tile.x0, tile.y1, tile.x1)
+        tile_rgb = np.ascontiguousarray(image_rgb[tile.y0:tile.y1, tile.x0:tile.x1])
+        units.append((bounds, compute_image_hash(tile_rgb)))
+    return units
+
+
+def clean_stale_temp_files(store_dir, variant, max_age_seconds=3600):
+    """清理上次被强制中断时残留的临时文件（只删较旧的，避免误删服务端正在写入的文件）"""
+    removed = 0
+    now = time.time()
+    for tmp_path in glob.glob(os.path.join(store_dir, variant, "*.tmp")):
+        if now - os.path.getmtime(tmp_path) > max_age_seconds:
+            os.remove(tmp_path)
+            removed += 1
+    return removed
+
+
+def init_worker(checkpoint_path, model_type, quantize_encoder, store_dir, torch_threads):
+    """工作进程初始化：限制线程数后加载模型"""
+    global _predictor, _store, _variant
+    import torch
+    from segment_anything import SamPredictor
+    from sam_loader import build_sam
+
+    # 每个进程只用分到的核，避免 workers x 全部核心 的超额订阅
+    torch.set_num_threads(torch_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    cv2.setNumThreads(1)
+
+    _predictor = SamPredictor(build_sam(checkpoint_path, model_type, quantize_encoder=quantize_encoder))
+    _store = EmbeddingStore(store_dir)
+    _variant = embedding_variant(model_type, quantize_encoder)
+
+
+def encode_unit(image_path, bounds, expected_hash):
+    """在工作进程中编码一个单元（整图或瓦片）并写入存储"""
+    start = time.time()
+    if _store.has(expected_hash, _variant):
+        return image_path, bounds, "skipped", 0.0
+
+    image_rgb = read_image_rgb(image_path)
+    if bounds is not None:
+        y0, x0, y1, x1 = bounds
+        image_rgb = np.ascontiguousarray(image_rgb[y0:y1, x0:x1])
+    if compute_image_hash(image_rgb) != expected_hash:
+        # 规划之后文件被改写，按新内容重新规划即可
+        return image_path, bounds, "changed", 0.0
+
+    _predictor.set_image(image_rgb)
+    _store.save(expected_hash, _variant, capture_predictor_state(_predictor))
+    _predictor.reset_image()
+    return image_path, bounds, "encoded", time.time() - start
+
+
+def precompute_embeddings(image_dir, store_dir="embedding_store", checkpoint_path="sam_vit_b_01ec64.pth",
+                          model_type="vit_b", quantize_encoder=False, workers=2, threads_per_worker=None,
+                          tile_threshold=2048, recursive=True):
+    """批量预编码目录下的所有图像，返回各状态的计数"""
+    variant = embedding_variant(model_type, quantize_encoder)
+    store = EmbeddingStore(store_dir)
+    removed = clean_stale_temp_files(store_dir, variant)
+    if removed:
+        print(f"Removed {removed} stale temporary files")
+
+    images = find_images(image_dir, recursive=recursive)
+    print(f"Found {len(images)} images in {image_dir}")
+
+    pending = []
+    counts = {"encoded": 0, "skipped": 0, "changed": 0, "failed": 0}
+    for image_path in images:
+        try:
+            units = plan_units(image_path, tile_threshold=tile_threshold)
+        except Exception as e:
+            print(f"  ✗ {image_path}: {e}")
+            counts["failed"] += 1
+            continue
+        for bounds, image_hash in units:
+            if store.has(image_hash, variant):
+                counts["skipped"] += 1
+            else:
+                pending.append((image_path, bounds, image_hash))
+
+    print(f"{counts['skipped']} units already in store, {len(pending)} to encode")
+    if not pending:
+        return counts
+
+    workers = max(1, min(workers, len(pending)))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Encoding with {workers} worker processes x {threads_per_worker} torch threads...")
+
+    start = time.time()
+    # spawn：避免在已初始化torch线程池的父进程上fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(checkpoint_path, model_type, quantize_encoder, store_dir,
+                                       threads_per_worker)) as executor:
+        futures = [executor.submit(encode_unit, *unit) for unit in pending]
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    image_path, bounds, status, seconds = future.result()
+                except Exception as e:
+                    print(f"  ✗ [{done}/{len(pending)}] {e}")
+                    counts["failed"] += 1
+                    continue
+                counts[status] += 1
+                tile_info = f" tile {bounds}" if bounds is not None else ""
+                print(f"  ✓ [{done}/{len(pending)}] {image_path}{tile_info}: {status} ({seconds:.1f}s)")
+        except KeyboardInterrupt:
+            # 已写入的嵌入保持完整，下次运行从剩余单元继续
+            print("Interrupted, cancelling pending work...")
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    print(f"Done in {time.time() - start:.1f}s: {counts}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-encode floor maps into the SAM embedding store")
+    parser.add_argument("image_dir", help="包含楼层图的目录")
+    parser.add_argument("--store-dir", default="embedding_store")
+    parser.add_argument("--checkpoint", default="sam_vit_b_01ec64.pth")
+    parser.add_argument("--model-type", default="vit_b")
+    parser.add_argument("--quantize-encoder", action="store_true")
+    parser.add_argument("--workers", type=int, default=2, help="编码进程数（ViT-B每个进程约需3GB内存）")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="每个进程的torch线程数（默认CPU核数/进程数）")
+    parser.add_argument("--tile-threshold", type=int, default=2048,
+                        help="长边超过该值的图像按瓦片编码（与服务端一致）")
+    parser.add_argument("--no-recursive", action="store_true")
+    args = parser.parse_args()
+
+    counts = precompute_embeddings(
+        args.image_dir,
+        store_dir=args.store_dir,
+        checkpoint_path=args.checkpoint,
+        model_type=args.model_type,
+        quantize_encoder=args.quantize_encoder,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        tile_threshold=args.tile_threshold,
+        recursive=not args.no_recursive,
+    )
+    raise SystemExit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
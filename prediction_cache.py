@@ -0,0 +1,39 @@
+from embedding_cache import EmbeddingCache
+
+
+def _normalize_coords(values, precision=2):
+    """坐标统一为保留两位小数的浮点元组，[[300, 150]] 与 [[300.0, 150.0]] 得到相同的键"""
+    return tuple(tuple(round(float(v), precision) for v in item) for item in (values or []))
+
+
+def prediction_cache_key(model, image_hash, points=None, point_labels=None, boxes=None,
+                         mask_encoding="raw", output_format="mask", refine=True):
+    """结果缓存键：(模型, 图像哈希, 规范化的点/标签/框, 输出格式)
+
+    点的顺序保留不变：解码器对提示顺序并不严格无关。
+    """
+    return (
+        model,
+        image_hash,
+        _normalize_coords(points),
+        tuple(int(label) for label in (point_labels or [])),
+        _normalize_coords(boxes),
+        mask_encoding,
+        output_format,
+        bool(refine),
+    )
+
+
+class PredictionCache(EmbeddingCache):
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """预测结果LRU缓存：保存已序列化的响应体及最佳候选的低分辨率logits
+
+        logits用于命中时更新会话状态，保证之后的增量请求与未命中时一致。
+        """
+        super().__init__(max_bytes=max_bytes)
+
+    def entry_bytes(self, entry):
+        size = len(entry["body"])
+        if entry.get("mask_logits") is not None:
+            size += int(entry["mask_logits"].nbytes)
+        return size
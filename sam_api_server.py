@@ -1,196 +1,936 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g
 from flask_cors import CORS
 import cv2
 import numpy as np
-from segment_anything import sam_model_registry, SamPredictor
+from segment_anything import SamPredictor
 import json
 import base64
 from PIL import Image
 import io
+import argparse
+import os
+import time
+import threading
+import torch
+from sam_loader import build_sam, embedding_variant
+from embedding_cache import EmbeddingCache, EmbeddingStore, compute_image_hash, capture_predictor_state, restore_predictor_state
+from session_manager import SessionManager
+from image_registry import ImageRegistry
+from color_regions import ColorRegionMap, ColorRegionCache
+from automatic_masks import SteppedMaskGenerator, MaskBank, MaskBankCache
+from segmentation_jobs import JobManager, normalize_job_params
+from extract_precise_boundaries import PreciseMallSegmenter
+from tiled_encoding import TiledImage, TILE_SIZE, TILE_OVERLAP
+from prediction_cache import PredictionCache, prediction_cache_key
+from inference_worker import InferenceWorker, InferenceQueueFull
+from onnx_decoder import OnnxMaskDecoder
+from latency_metrics import LatencyMetrics, RequestTimings
+from hover_channel import run_hover_channel
+from mask_encoding import MASK_ENCODINGS, OUTPUT_FORMATS, encode_mask, mask_to_polygon
 # from scipy import ndimage  # 移除scipy依赖
 
+try:
+    from flask_sock import Sock
+except ImportError:  # flask-sock为可选依赖，缺失时不提供悬停预览WebSocket
+    Sock = None
+
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
+sock = Sock(app) if Sock is not None else None
+# 生产模式下悬停WebSocket使用的独立端口（None表示与HTTP同一端口）
+hover_socket_port = None
+# 上传接口接收原始图像字节，限制单个请求体大小
+app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
 
 class SAMAPIServer:
-    def __init__(self, checkpoint_path="sam_vit_b_01ec64.pth"):
+    def __init__(self, checkpoint_path="sam_vit_b_01ec64.pth", cache_max_bytes=256 * 1024 * 1024,
+                 store_dir="embedding_store", session_ttl=1800, max_sessions=64, batch_max_wait_ms=5, batch_max_size=8,
+                 decoder_backend="torch", quantize_encoder=False, max_queue=64, metrics=None,
+                 prediction_cache_max_bytes=64 * 1024 * 1024, tile_threshold=2048, tile_size=TILE_SIZE,
+                 tile_overlap=TILE_OVERLAP, max_tiles_per_prompt=4, image_registry_max_bytes=512 * 1024 * 1024,
+                 color_region_cache_max_bytes=256 * 1024 * 1024, auto_masks=False, auto_mask_params=None,
+                 mask_bank_max_bytes=256 * 1024 * 1024):
         """初始化SAM API服务器"""
         print("Loading SAM model...")
-        self.sam = sam_model_registry["vit_b"](checkpoint=checkpoint_path)
+        self.model_type = "vit_b"
+        self.sam = build_sam(checkpoint_path, self.model_type, quantize_encoder=quantize_encoder)
+        # 量化编码器产生的嵌入单独缓存
+        self.embedding_variant = embedding_variant(self.model_type, quantize_encoder)
         self.predictor = SamPredictor(self.sam)
         self.current_image = None
+        self.current_image_hash = None
+        # 图像嵌入缓存（按像素哈希寻址），避免重复运行图像编码器
+        self.embedding_cache = EmbeddingCache(max_bytes=cache_max_bytes)
+        # 磁盘嵌入存储，服务重启后无需重新编码
+        self.embedding_store = EmbeddingStore(store_dir) if store_dir else None
+        # 预测结果缓存：相同图像+相同提示直接返回已序列化的响应体
+        self.prediction_cache = PredictionCache(max_bytes=prediction_cache_max_bytes)
+        # 长边超过tile_threshold的大图使用重叠瓦片编码，瓦片在被点击覆盖时才编码
+        self.tile_threshold = tile_threshold
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.max_tiles_per_prompt = max_tiles_per_prompt
+        # 上传的图像按像素哈希注册，image_id 可直接用于之后的预测请求
+        self.images = ImageRegistry(max_bytes=image_registry_max_bytes,
+                                    on_evict=lambda image_id: self.image_sessions.pop(image_id, None))
+        self.image_sessions = {}
+        # 每张图像的量化颜色连通域，初始化时计算一次，色块引导点击时只查表
+        self.color_regions = ColorRegionCache(max_bytes=color_region_cache_max_bytes)
+        # 可选：初始化后在后台运行自动掩码生成，点击先查掩码索引，未命中再实时解码
+        self.auto_masks = auto_masks
+        self.auto_mask_params = dict(auto_mask_params or {"points_per_side": 32, "points_per_batch": 4,
+                                                          "min_mask_region_area": 100})
+        self.mask_banks = MaskBankCache(max_bytes=mask_bank_max_bytes)
+        self.mask_bank_builds = set()
+        self.mask_bank_lock = threading.Lock()
+        # 异步自动分割任务（/api/jobs），结果按图像哈希+生成参数缓存
+        self.jobs = JobManager(self.run_segmentation_job)
+        # 每个客户端一个会话，共享同一个模型；预测器同一时刻只服务一个会话
+        self.sessions = SessionManager(ttl_seconds=session_ttl, max_sessions=max_sessions)
+        self.default_session_id = None
+        self.active_image_hash = None
+        self.model_lock = threading.Lock()
+        # 各阶段延迟直方图
+        self.metrics = metrics if metrics is not None else LatencyMetrics()
+        # 专用推理线程独占PyTorch模型：编码与解码都经有界队列提交，
+        # 并发解码请求在窗口内合并（batch_max_size<=1时不合并）
+        self.inference_worker = InferenceWorker(self, max_wait_ms=batch_max_wait_ms,
+                                                max_batch=batch_max_size, max_queue=max_queue,
+                                                metrics=self.metrics)
+        # 可选的ONNX Runtime解码器，不可用时回退到PyTorch
+        self.onnx_decoder = None
+        if decoder_backend == "onnx":
+            try:
+                self.onnx_decoder = OnnxMaskDecoder(self.sam, checkpoint_path)
+                print(f"Using ONNX Runtime mask decoder: {self.onnx_decoder.onnx_path}")
+            except Exception as e:
+                print(f"ONNX decoder unavailable ({e}), falling back to PyTorch")
         print("SAM model loaded successfully!")
         
-    def set_image(self, image_path):
-        """设置图像"""
-        try:
-            image = cv2.imread(image_path)
-            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    def load_embedding(self, image_rgb, image_hash, timings=None):
+        """获取图像嵌入：内存缓存 -> 磁盘存储 -> 图像编码器"""
+        timings = timings or RequestTimings()
+        cache_key = f"{self.embedding_variant}/{image_hash}"
+        
+        cached = self.embedding_cache.get(cache_key)
+        if cached is not None:
+            return cached, "cached"
+        
+        with timings.stage("embedding_load"):
+            stored = self.embedding_store.load(image_hash, self.embedding_variant) if self.embedding_store else None
+            if stored is not None:
+                # 内存映射数组只复制一次，之后会话间共享同一个张量
+                stored["features"] = torch.from_numpy(np.array(stored["features"]))
+        if stored is not None:
+            self.embedding_cache.put(cache_key, stored)
+            return stored, "stored"
+        
+        with timings.stage("encoder"):
+            entry = self.inference_worker.run_job(self.encode_image, image_rgb, image_hash)
+        self.embedding_cache.put(cache_key, entry)
+        if self.embedding_store:
+            with timings.stage("embedding_save"):
+                self.embedding_store.save(image_hash, self.embedding_variant, entry)
+        return entry, "encoded"
+    
+    def encode_image(self, image_rgb, image_hash):
+        """运行图像编码器（在推理线程上执行）"""
+        with self.model_lock:
             self.predictor.set_image(image_rgb)
-            self.current_image = image_rgb
-            return True, "Image set successfully"
+            self.active_image_hash = image_hash
+            return capture_predictor_state(self.predictor)
+    
+    def warm_up(self, size=256):
+        """用空白图像跑一次编码+解码预热算子，不写入缓存和会话"""
+        dummy = np.zeros((size, size, 3), dtype=np.uint8)
+        point = [[size // 2, size // 2]]
+        
+        def run():
+            with self.model_lock:
+                self.predictor.set_image(dummy)
+                embedding = capture_predictor_state(self.predictor)
+                self.predictor.predict(point_coords=np.array(point), point_labels=np.array([1]),
+                                       multimask_output=True, return_logits=True)
+                self.predictor.reset_image()
+                self.active_image_hash = None
+            return embedding
+        
+        embedding = self.inference_worker.run_job(run)
+        if self.onnx_decoder is not None:
+            self.onnx_decoder.predict(embedding, point_coords=np.array(point), point_labels=np.array([1]))
+    
+    def set_image(self, image_path, session_id=None, timings=None, tiled=None):
+        """设置图像，返回对应的会话
+
+        tiled=None 时长边超过tile_threshold自动启用瓦片模式；瓦片模式下此处不做任何编码。
+        """
+        timings = timings or RequestTimings()
+        try:
+            with timings.stage("image_decode"):
+                image = cv2.imread(image_path)
+                image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            with timings.stage("image_hash"):
+                image_hash = compute_image_hash(image_rgb)
+            return self.open_session(image_rgb, image_hash, session_id=session_id, timings=timings, tiled=tiled)
+        except InferenceQueueFull:
+            raise
+        except Exception as e:
+            return False, str(e), None
+    
+    def upload_image(self, data, session_id=None, timings=None, tiled=None):
+        """注册上传的图像字节并打开会话，返回 (success, message, session, deduplicated)
+
+        相同字节或相同像素的图像只解码一次，其嵌入直接命中缓存/存储。
+        """
+        timings = timings or RequestTimings()
+        try:
+            with timings.stage("image_decode"):
+                image_id, image_rgb, deduplicated = self.images.register(data)
+            success, message, session = self.open_session(image_rgb, image_id, session_id=session_id,
+                                                           timings=timings, tiled=tiled)
+            if success:
+                self.image_sessions[image_id] = session.session_id
+            return success, message, session, deduplicated
+        except InferenceQueueFull:
+            raise
         except Exception as e:
-            return False, str(e)
+            return False, str(e), None, False
+    
+    def session_for_image(self, image_id):
+        """已上传图像的默认会话，过期时用注册表中的图像重新打开；返回会话ID或None"""
+        session_id = self.image_sessions.get(image_id)
+        if session_id is not None and self.sessions.get(session_id) is not None:
+            return session_id
+        image_rgb = self.images.image(image_id)
+        if image_rgb is None:
+            return None
+        success, _, session = self.open_session(image_rgb, image_id)
+        if not success:
+            return None
+        self.image_sessions[image_id] = session.session_id
+        return session.session_id
     
-    def predict(self, points=None, boxes=None, point_labels=None):
-        """使用SAM进行预测"""
+    def open_session(self, image_rgb, image_hash, session_id=None, timings=None, tiled=None):
+        """为已解码的图像加载嵌入并创建会话"""
+        timings = timings or RequestTimings()
         try:
-            if self.current_image is None:
-                return False, "No image set", None
-            
-            # 暂时禁用色块增强，使用基本SAM功能
-            input_points = np.array(points) if points else None
-            input_labels = np.array(point_labels) if point_labels else None
-            
-            input_boxes = np.array(boxes) if boxes else None
+            if tiled is None:
+                tiled = max(image_rgb.shape[:2]) > self.tile_threshold
+            if tiled:
+                tiles = TiledImage(image_rgb, tile_size=self.tile_size, overlap=self.tile_overlap)
+                session = self.sessions.create(image_rgb, image_hash, None, session_id=session_id, tiles=tiles)
+                session.color_regions = self.load_color_regions(image_rgb, image_hash, timings=timings)
+                self.default_session_id = session.session_id
+                return True, f"Image set successfully (tiled, {len(tiles)} tiles encoded on demand)", session
             
-            # SAM预测 - 使用优化参数获得更精确边界
-            print(f"SAM预测输入:")
-            print(f"   点坐标: {input_points}")
-            print(f"   点标签: {input_labels}")
-            print(f"   图像形状: {self.current_image.shape}")
+            embedding, source = self.load_embedding(image_rgb, image_hash, timings=timings)
+            session = self.sessions.create(image_rgb, image_hash, embedding, session_id=session_id)
+            session.color_regions = self.load_color_regions(image_rgb, image_hash, timings=timings)
+            self.start_mask_bank(session)
+            # 未携带session_id的旧客户端使用最近一次初始化的会话
+            self.default_session_id = session.session_id
             
-            masks, scores, logits = self.predictor.predict(
-                point_coords=input_points,
-                point_labels=input_labels,
-                box=input_boxes,
-                multimask_output=True,  # 生成多个候选掩码以选择最佳
-                return_logits=True      # 返回logits以便进一步处理
+            messages = {
+                "cached": "Image set successfully (cached embedding)",
+                "stored": "Image set successfully (stored embedding)",
+                "encoded": "Image set successfully",
+            }
+            return True, messages[source], session
+        except InferenceQueueFull:
+            raise
+        except Exception as e:
+            return False, str(e), None
+    
+    def load_color_regions(self, image_rgb, image_hash, timings=None):
+        """获取图像的颜色连通域（按像素哈希缓存），计算失败时返回None，不影响SAM预测"""
+        timings = timings or RequestTimings()
+        entry = self.color_regions.get(image_hash)
+        if entry is not None:
+            return entry["regions"]
+        try:
+            with timings.stage("color_regions"):
+                regions = ColorRegionMap(image_rgb)
+        except Exception as e:
+            print(f"颜色连通域计算失败: {e}")
+            return None
+        self.color_regions.put(image_hash, {"regions": regions})
+        return regions
+    
+    def start_mask_bank(self, session):
+        """启用auto_masks时为会话的图像在后台构建掩码索引（已有或正在构建时跳过；瓦片模式不支持）"""
+        if not self.auto_masks or session.embedding is None:
+            return
+        with self.mask_bank_lock:
+            if session.image_hash in self.mask_bank_builds or session.image_hash in self.mask_banks:
+                return
+            self.mask_bank_builds.add(session.image_hash)
+        threading.Thread(target=self.build_mask_bank, args=(session.image, session.image_hash, session.embedding),
+                         name="sam-mask-bank", daemon=True).start()
+    
+    def build_mask_bank(self, image_rgb, image_hash, embedding):
+        """运行自动掩码生成并建立像素索引；每个编码/解码步骤都以低优先级提交给推理线程"""
+        start = time.time()
+        try:
+            generator = SteppedMaskGenerator(self.sam, run_step=self.inference_worker.run_background,
+                                             **self.auto_mask_params)
+            records = generator.generate(image_rgb, embedding=embedding)
+            bank = MaskBank(image_rgb.shape, records)
+            self.mask_banks.put(image_hash, {"bank": bank})
+            print(f"Mask bank for {image_hash[:12]}: {len(bank)} masks in {time.time() - start:.1f}s")
+        except Exception as e:
+            print(f"自动掩码生成失败: {e}")
+        finally:
+            with self.mask_bank_lock:
+                self.mask_bank_builds.discard(image_hash)
+    
+    def stored_embedding(self, image_hash):
+        """已有的整图嵌入（内存缓存或磁盘存储），没有时返回None，不触发编码"""
+        cached = self.embedding_cache.get(f"{self.embedding_variant}/{image_hash}")
+        if cached is not None:
+            return cached
+        if self.embedding_store is None or not self.embedding_store.has(image_hash, self.embedding_variant):
+            return None
+        # 存储中已有时 load_embedding 不会调用编码器
+        embedding, _ = self.load_embedding(None, image_hash)
+        return embedding
+    
+    def submit_segmentation_job(self, image_id=None, session_id=None, image_path=None, params=None):
+        """提交自动分割任务，图像可由 image_id、session_id 或 image_path 指定；返回 SegmentationJob"""
+        params = normalize_job_params(params)
+        if image_id:
+            image_rgb, image_hash = self.images.image(image_id), image_id
+            if image_rgb is None:
+                raise KeyError(f"Unknown image_id: {image_id}")
+        elif session_id:
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise KeyError(f"Unknown or expired session: {session_id}")
+            image_rgb, image_hash = session.image, session.image_hash
+        elif image_path:
+            image = cv2.imread(image_path)
+            if image is None:
+                raise ValueError(f"Cannot read image: {image_path}")
+            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            image_hash = compute_image_hash(image_rgb)
+        else:
+            raise ValueError("image_id, session_id or image_path is required")
+        
+        return self.jobs.submit(image_rgb, image_hash, params, model=self.embedding_variant,
+                                embedding=self.stored_embedding(image_hash))
+    
+    def run_segmentation_job(self, job, image_rgb, embedding):
+        """执行自动分割任务（JobManager后台线程），返回经 PreciseMallSegmenter 过滤后的店铺多边形"""
+        start = time.time()
+        generator = SteppedMaskGenerator(self.sam, run_step=self.inference_worker.run_background,
+                                         on_progress=job.update_progress,
+                                         points_per_batch=self.auto_mask_params.get("points_per_batch", 4),
+                                         **job.params)
+        job.total = generator.count_points(image_rgb.shape)
+        records = generator.generate(image_rgb, embedding=embedding)
+        polygons = PreciseMallSegmenter.extract_polygons(PreciseMallSegmenter.analyze_masks(image_rgb, records))
+        print(f"Segmentation job {job.job_id}: {len(records)} masks -> {len(polygons)} polygons "
+              f"in {time.time() - start:.1f}s")
+        return polygons
+    
+    def lookup_mask_bank(self, session, points, point_labels):
+        """单个正样本点且掩码索引已就绪时直接查表，返回 (masks, scores)，未命中返回None"""
+        if not points or len(points) != 1 or (point_labels and point_labels[0] != 1):
+            return None
+        entry = self.mask_banks.get(session.image_hash)
+        if entry is None:
+            return None
+        bank = entry["bank"]
+        mask_id = bank.mask_at(points[0][0], points[0][1])
+        if not mask_id:
+            return None
+        return bank.mask(mask_id)[None, :, :], np.array([bank.masks[mask_id]["score"]], dtype=np.float32)
+    
+    def activate_session(self, session):
+        """将会话的嵌入装入共享预测器（调用方需持有model_lock）"""
+        if self.active_image_hash != session.image_hash:
+            restore_predictor_state(self.predictor, session.embedding)
+            self.active_image_hash = session.image_hash
+        self.current_image = session.image
+        self.current_image_hash = session.image_hash
+    
+    def predict(self, points=None, boxes=None, point_labels=None, session_id=None, mask_encoding="raw",
+                output_format="mask", incremental=False, timings=None, refine=True, color_guidance=False,
+                hybrid=False):
+        """在指定会话上进行预测
+
+        incremental=True 时只需传入新增的点：服务端将其追加到会话已有提示中，
+        并把上一次最佳候选的低分辨率logits作为 mask_input（官方SAM交互流程）。
+        refine=False 时跳过边界精化，直接返回SAM掩码。
+        color_guidance=True 时在正样本点所在色块的边界上追加引导点。
+        hybrid=True 时以点击所在色块的外接框作为框提示，只解码一个掩码。
+        """
+        timings = timings or RequestTimings()
+        if mask_encoding not in MASK_ENCODINGS:
+            return False, f"Unknown mask encoding: {mask_encoding}", None
+        if output_format not in OUTPUT_FORMATS:
+            return False, f"Unknown output format: {output_format}", None
+        
+        success, message, decoded = self.predict_masks(points=points, boxes=boxes, point_labels=point_labels,
+                                                       session_id=session_id, incremental=incremental,
+                                                       timings=timings, color_guidance=color_guidance,
+                                                       hybrid=hybrid)
+        if not success:
+            return False, message, None
+        masks, scores = decoded
+        
+        return self.build_prediction_result(masks, scores, mask_encoding=mask_encoding,
+                                            output_format=output_format, timings=timings, refine=refine)
+    
+    def predict_stream(self, points=None, boxes=None, point_labels=None, session_id=None, mask_encoding="rle",
+                       output_format="mask", incremental=False, timings=None, refine=True,
+                       color_guidance=False, hybrid=False):
+        """流式预测：先完成解码，返回 (success, message, NDJSON行生成器)"""
+        if mask_encoding not in MASK_ENCODINGS:
+            return False, f"Unknown mask encoding: {mask_encoding}", None
+        if output_format not in OUTPUT_FORMATS:
+            return False, f"Unknown output format: {output_format}", None
+        
+        success, message, decoded = self.predict_masks(points=points, boxes=boxes, point_labels=point_labels,
+                                                       session_id=session_id, incremental=incremental,
+                                                       timings=timings, color_guidance=color_guidance,
+                                                       hybrid=hybrid)
+        if not success:
+            return False, message, None
+        masks, scores = decoded
+        return True, message, self.stream_prediction_result(masks, scores, mask_encoding=mask_encoding,
+                                                            output_format=output_format, refine=refine,
+                                                            timings=timings)
+    
+    def predict_masks(self, points=None, boxes=None, point_labels=None, session_id=None, incremental=False,
+                      timings=None, record_prompt=True, color_guidance=False, hybrid=False):
+        """解码会话提示并记录到会话，返回 (success, message, (masks, scores))
+
+        record_prompt=False 用于悬停预览，不覆盖会话中点击累积的提示和logits。
+        hybrid=True 且请求未带框时，由正样本点所在色块推导框提示，点+框只解码一个掩码；
+        点击不在可用色块上时按普通请求处理。
+        """
+        timings = timings or RequestTimings()
+        session = self.sessions.get(session_id or self.default_session_id)
+        if session is None:
+            return False, "Unknown or expired session", None
+        
+        if (self.auto_masks and not boxes and not hybrid and not color_guidance
+                and not (incremental and session.has_prompt())):
+            with timings.stage("mask_bank"):
+                banked = self.lookup_mask_bank(session, points, point_labels)
+            if banked is not None:
+                if record_prompt:
+                    # 没有低分辨率logits，之后的增量请求按点重新解码
+                    session.update_prompt(points, point_labels or [1], None, None)
+                return True, "Prediction successful (mask bank)", banked
+        
+        if color_guidance and points:
+            with timings.stage("color_guidance"):
+                points, point_labels = self.enhance_points_with_color_analysis(
+                    session.color_regions, points, point_labels or [1] * len(points))
+        
+        mask_input = None
+        if incremental and session.has_prompt():
+            points = session.prompt_points + list(points or [])
+            point_labels = session.prompt_labels + list(point_labels or [])
+            boxes = boxes or session.prompt_boxes
+            mask_input = session.mask_logits
+        # 有上一轮logits时提示已无歧义，只输出单个掩码
+        multimask_output = mask_input is None
+        
+        if hybrid and not boxes:
+            color_box = self.color_region_box(session.color_regions, points, point_labels)
+            if color_box is not None:
+                # 点+紧贴色块的框已无歧义，不再输出三个候选
+                boxes = [color_box]
+                multimask_output = False
+        
+        try:
+            if session.tiles is not None:
+                masks, scores, logits = self.decode_tiled(session, points, point_labels, boxes,
+                                                          multimask_output=multimask_output, timings=timings)
+            else:
+                with timings.stage("decoder"):
+                    masks, scores, logits = self.decode(session, points, point_labels, boxes,
+                                                        mask_input=mask_input, multimask_output=multimask_output)
+        except InferenceQueueFull:
+            raise
+        except Exception as e:
+            return False, str(e), None
+        
+        if record_prompt:
+            best_idx = int(np.argmax(scores))
+            session.update_prompt(points, point_labels, boxes,
+                                  logits[best_idx][None, :, :] if logits is not None else None)
+        return True, "Prediction successful", (masks, scores)
+    
+    def decode(self, session, points, point_labels, boxes, mask_input=None, multimask_output=True):
+        """选择解码路径：ONNX解码器 -> 推理线程批量解码 -> 推理线程逐个解码"""
+        if self.onnx_decoder is not None:
+            # ONNX解码器直接使用会话的嵌入，无需占用共享预测器
+            return self.onnx_decoder.predict(
+                session.embedding,
+                point_coords=np.array(points) if points else None,
+                point_labels=np.array(point_labels) if point_labels else None,
+                box=np.array(boxes) if boxes else None,
+                mask_input=mask_input,
+                multimask_output=multimask_output
             )
+        if self.inference_worker.accepts(boxes):
+            # 并发请求合并为一次批量解码
+            return self.inference_worker.submit(session, points, point_labels, boxes,
+                                                mask_input=mask_input, multimask_output=multimask_output)
+        return self.inference_worker.run_job(
+            self.predict_session, session, points=points, boxes=boxes, point_labels=point_labels,
+            mask_input=mask_input, multimask_output=multimask_output
+        )
+    
+    def predict_response(self, points=None, boxes=None, point_labels=None, session_id=None, mask_encoding="raw",
+                         output_format="mask", incremental=False, timings=None, refine=True,
+                         color_guidance=False, hybrid=False):
+        """返回序列化后的/api/predict响应体 (success, message, body)，相同提示命中结果缓存"""
+        timings = timings or RequestTimings()
+        session = self.sessions.get(session_id or self.default_session_id)
+        
+        cache_key = None
+        # 增量请求依赖会话中上一轮的提示和logits，不参与缓存
+        if session is not None and not (incremental and session.has_prompt()):
+            decoder = "onnx" if self.onnx_decoder is not None else "torch"
+            if session.tiles is not None:
+                decoder += "/tiled"
+            if color_guidance:
+                decoder += "/color"
+            if hybrid:
+                decoder += "/hybrid"
+            cache_key = prediction_cache_key(f"{self.embedding_variant}/{decoder}", session.image_hash,
+                                             points, point_labels, boxes, mask_encoding=mask_encoding,
+                                             output_format=output_format, refine=refine)
+            cached = self.prediction_cache.get(cache_key)
+            if cached is not None:
+                if color_guidance and points:
+                    # 与未命中时一致，会话记录增强后的提示
+                    points, point_labels = self.enhance_points_with_color_analysis(
+                        session.color_regions, points, point_labels or [1] * len(points))
+                if hybrid and not boxes:
+                    # 缓存的logits来自点+色块框的解码，会话同样要记录该框
+                    color_box = self.color_region_box(session.color_regions, points, point_labels)
+                    if color_box is not None:
+                        boxes = [color_box]
+                session.update_prompt(points, point_labels, boxes, cached["mask_logits"])
+                return True, "Prediction successful (cached)", cached["body"]
+        
+        success, message, result = self.predict(
+            points=points, boxes=boxes, point_labels=point_labels, session_id=session_id,
+            mask_encoding=mask_encoding, output_format=output_format, incremental=incremental,
+            timings=timings, refine=refine, color_guidance=color_guidance, hybrid=hybrid
+        )
+        if not success:
+            return False, message, None
+        
+        with timings.stage("serialization"):
+            response = {"success": True, "message": message}
+            response.update(result)
+            # 向后兼容
+            if "best_mask" in result:
+                response["mask"] = result["best_mask"]
+            response["score"] = result["best_score"]
+            body = json.dumps(response).encode("utf-8")
+        
+        if cache_key is not None:
+            self.prediction_cache.put(cache_key, {"body": body, "mask_logits": session.mask_logits})
+        return True, message, body
+    
+    def color_region_box(self, color_regions, points=None, point_labels=None, max_area_fraction=0.25):
+        """正样本点所在色块的外接框 [x0, y0, x1, y1]（多个色块取并集），没有可用色块时返回None
+
+        背景、走廊等超过图像 max_area_fraction 的大色块不作为框提示。
+        """
+        if color_regions is None or not points:
+            return None
+        max_area = max_area_fraction * color_regions.shape[0] * color_regions.shape[1]
+        bboxes = []
+        for point, label in zip(points, point_labels or [1] * len(points)):
+            component = color_regions.component_at(point[0], point[1]) if label == 1 else 0
+            if component and color_regions.areas[component] <= max_area:
+                bbox = color_regions.polygon_info(component)["bbox"]
+                bboxes.append([bbox["x"], bbox["y"], bbox["x"] + bbox["width"], bbox["y"] + bbox["height"]])
+        if not bboxes:
+            return None
+        bboxes = np.asarray(bboxes)
+        return [int(bboxes[:, 0].min()), int(bboxes[:, 1].min()), int(bboxes[:, 2].max()), int(bboxes[:, 3].max())]
+    
+    def color_components(self, color_regions, points=None, point_labels=None, boxes=None):
+        """提示对应的色块：正样本点（无点时取框中心）所在连通域并集，减去负样本点所在连通域"""
+        include, exclude = set(), set()
+        for point, label in zip(points or [], point_labels or [1] * len(points or [])):
+            component = color_regions.component_at(point[0], point[1])
+            if component:
+                (include if label == 1 else exclude).add(component)
+        if not points:
+            for x0, y0, x1, y1 in boxes or []:
+                component = color_regions.component_at((x0 + x1) / 2.0, (y0 + y1) / 2.0)
+                if component:
+                    include.add(component)
+        return tuple(sorted(include - exclude))
+    
+    def color_result(self, color_regions, components, mask_encoding="raw", output_format="mask", timings=None):
+        """由色块组装与SAM相同结构的响应数据（单个掩码，score为1.0）"""
+        timings = timings or RequestTimings()
+        shape = [int(color_regions.shape[0]), int(color_regions.shape[1])]
+        with timings.stage("serialization"):
+            if output_format == "polygon":
+                if len(components) == 1:
+                    # 单个色块直接使用缓存的多边形，无需生成整图掩码
+                    shape_info = dict(color_regions.polygon_info(components[0]))
+                else:
+                    mask = np.logical_or.reduce([color_regions.component_mask(c) for c in components])
+                    shape_info = mask_to_polygon(mask)
+                shape_info.update({"score": 1.0, "is_best": True})
+                return {
+                    "masks": [shape_info],
+                    "best_polygon": shape_info,
+                    "format": "polygon",
+                    "mode": "color",
+                    "best_score": 1.0,
+                    "shape": shape,
+                    "num_masks": 1
+                }
+            
+            mask = np.logical_or.reduce([color_regions.component_mask(c) for c in components])
+            encoded = encode_mask(mask, mask_encoding)
+            return {
+                "masks": [{"mask": encoded, "score": 1.0, "is_best": True, "area": int(np.count_nonzero(mask))}],
+                "best_mask": encoded,
+                "mask_encoding": mask_encoding,
+                "format": "mask",
+                "mode": "color",
+                "best_score": 1.0,
+                "shape": shape,
+                "num_masks": 1
+            }
+    
+    def color_response(self, points=None, boxes=None, point_labels=None, session_id=None, mask_encoding="raw",
+                       output_format="mask", timings=None):
+        """色块模式（mode=color）：由初始化时预先计算的同色连通域直接回答，不运行SAM解码器
+
+        适合纯色店铺色块的悬停预览；不修改会话中累积的SAM提示。
+        响应体按（图像哈希、色块集合、输出格式）缓存，同一色块内任意位置的请求都直接命中。
+        返回 (success, message, body)。
+        """
+        timings = timings or RequestTimings()
+        if mask_encoding not in MASK_ENCODINGS:
+            return False, f"Unknown mask encoding: {mask_encoding}", None
+        if output_format not in OUTPUT_FORMATS:
+            return False, f"Unknown output format: {output_format}", None
+        session = self.sessions.get(session_id or self.default_session_id)
+        if session is None:
+            return False, "Unknown or expired session", None
+        if session.color_regions is None:
+            return False, "Color regions unavailable for this image", None
+        
+        components = self.color_components(session.color_regions, points, point_labels, boxes)
+        if not components:
+            return False, "No color region at prompt", None
+        
+        cache_key = ("color", session.image_hash, components, mask_encoding, output_format)
+        cached = self.prediction_cache.get(cache_key)
+        if cached is not None:
+            return True, "Prediction successful (cached)", cached["body"]
+        
+        result = self.color_result(session.color_regions, components, mask_encoding=mask_encoding,
+                                   output_format=output_format, timings=timings)
+        with timings.stage("serialization"):
+            response = {"success": True, "message": "Prediction successful"}
+            response.update(result)
+            # 向后兼容
+            if "best_mask" in result:
+                response["mask"] = result["best_mask"]
+            response["score"] = result["best_score"]
+            body = json.dumps(response).encode("utf-8")
+        self.prediction_cache.put(cache_key, {"body": body, "mask_logits": None})
+        return True, "Prediction successful", body
+    
+    def decode_tiled(self, session, points, point_labels, boxes, multimask_output=True, timings=None):
+        """瓦片模式解码，返回原图尺寸的 (masks, scores, None)
+
+        先解码覆盖提示的瓦片（离提示中心最近的瓦片提供分数），各瓦片掩码按核心区拼接；
+        最佳掩码被切断在未解码瓦片的边界上时，以掩码内的像素为正样本点继续解码相邻瓦片，
+        最多 max_tiles_per_prompt 块。瓦片的低分辨率logits无法跨瓦片复用，因此不返回。
+        """
+        timings = timings or RequestTimings()
+        tiled = session.tiles
+        if boxes and len(boxes) > 1:
+            raise ValueError("Tiled mode supports a single box per prompt")
+        
+        pending = [(tile, points, point_labels, boxes)
+                   for tile in tiled.tiles_for_prompt(points, point_labels, boxes)]
+        if not pending:
+            raise ValueError("Prompt lies outside the image")
+        negatives = [point for point, label in zip(points or [], point_labels or []) if label == 0]
+        
+        def load_tile_embedding(tile_rgb, tile_hash):
+            return self.load_embedding(tile_rgb, tile_hash, timings=timings)
+        
+        canvas = scores = None
+        decoded = set()
+        while pending and len(decoded) < self.max_tiles_per_prompt:
+            tile, tile_points, tile_labels, tile_boxes = pending.pop(0)
+            if tile.index in decoded:
+                continue
+            tile_points, tile_labels, tile_boxes = tiled.tile_prompt(tile, tile_points, tile_labels, tile_boxes)
+            if not tile_points and not tile_boxes:
+                continue
             
-            print(f"SAM预测输出:")
-            print(f"   掩码数量: {len(masks)}")
-            print(f"   掩码形状: {masks[0].shape if len(masks) > 0 else 'None'}")
-            print(f"   置信度分数: {scores}")
-            print(f"   最高分数索引: {np.argmax(scores)}")
+            tile_session = tiled.tile_session(tile, load_tile_embedding)
+            with timings.stage("decoder"):
+                masks, tile_scores, _ = self.decode(tile_session, tile_points or None, tile_labels or None,
+                                                    tile_boxes or None, multimask_output=multimask_output)
+            if canvas is None:
+                canvas = np.zeros((len(masks),) + tiled.shape, dtype=bool)
+                scores = tile_scores
+            tiled.paste(canvas, tile, masks)
+            decoded.add(tile.index)
             
-            # 确保掩码是布尔类型
+            if not pending:
+                best_mask = canvas[int(np.argmax(scores))]
+                for neighbor in tiled.tiles:
+                    if neighbor.index in decoded:
+                        continue
+                    # 邻块核心区尚为空，外扩1像素的窗口内有掩码说明对象在核心区边界被切断
+                    cy0, cx0, cy1, cx1 = neighbor.core
+                    if not best_mask[max(cy0 - 1, 0):cy1 + 1, max(cx0 - 1, 0):cx1 + 1].any():
+                        continue
+                    seed = tiled.expansion_point(neighbor, best_mask)
+                    if seed is not None:
+                        pending.append((neighbor, [seed] + negatives, [1] + [0] * len(negatives), None))
+        
+        if canvas is None:
+            raise ValueError("No tile received a usable prompt")
+        return canvas, scores, None
+    
+    def predict_session(self, session, **kwargs):
+        """装入会话嵌入后解码（在推理线程上执行）"""
+        with self.model_lock:
+            self.activate_session(session)
+            return self.predict_active(**kwargs)
+    
+    def predict_active(self, points=None, boxes=None, point_labels=None, mask_input=None, multimask_output=True):
+        """使用SAM对当前装入预测器的图像进行解码（调用方需持有model_lock）"""
+        # 暂时禁用色块增强，使用基本SAM功能
+        input_points = np.array(points) if points else None
+        input_labels = np.array(point_labels) if point_labels else None
+        
+        input_boxes = np.array(boxes) if boxes else None
+        
+        # SAM预测 - 使用优化参数获得更精确边界
+        masks, scores, logits = self.predictor.predict(
+            point_coords=input_points,
+            point_labels=input_labels,
+            box=input_boxes,
+            mask_input=mask_input,  # 上一轮最佳候选的低分辨率logits
+            multimask_output=multimask_output,  # 首次点击生成多个候选掩码以选择最佳
+            return_logits=True      # 返回logits以便进一步处理
+        )
+        
+        return masks, scores, logits
+    
+    def build_prediction_result(self, masks, scores, mask_encoding="raw", output_format="mask", timings=None,
+                                refine=True):
+        """对解码结果做边界精化并组装响应数据"""
+        timings = timings or RequestTimings()
+        try:
+            # 确保掩码是布尔类型；候选堆栈只精化一次，best_mask直接复用
             masks = masks > 0
+            if refine:
+                with timings.stage("refinement"):
+                    masks, areas = self.refine_mask_stack(masks)
+            else:
+                areas = self.mask_areas(masks)
             
-            # 返回所有掩码选项（参考官方演示）
-            mask_data = []
-            best_idx = np.argmax(scores)
+            if output_format == "polygon":
+                return self.build_polygon_result(masks, scores, timings=timings)
             
-            for i, (mask, score) in enumerate(zip(masks, scores)):
-                # 边界精确化处理
-                refined_mask = self.refine_mask_boundaries(mask)
-                
+            # 返回所有掩码选项（参考官方演示）
+            best_idx = int(np.argmax(scores))
+            with timings.stage("serialization"):
                 # 确保所有数值都是Python原生类型，避免JSON序列化错误
-                mask_array = (refined_mask * 255).astype(np.uint8)  # 转换为0-255范围
-                mask_data.append({
-                    "mask": mask_array.tolist(),
-                    "score": float(score),
-                    "is_best": bool(i == best_idx),  # 显式转换为Python bool
-                    "area": int(np.sum(refined_mask > 0))  # 计算真实面积
-                })
-            
-            # 选择最佳掩码（使用精确化后的掩码）
-            best_mask = self.refine_mask_boundaries(masks[best_idx])
-            best_score = scores[best_idx]
+                encoded = [encode_mask(mask, mask_encoding) for mask in masks]
+                mask_data = [{
+                    "mask": encoded[i],
+                    "score": float(scores[i]),
+                    "is_best": bool(i == best_idx),
+                    "area": int(areas[i])
+                } for i in range(len(masks))]
             
             return True, "Prediction successful", {
                 "masks": mask_data,
-                "best_mask": (best_mask * 255).astype(np.uint8).tolist(),  # 转换为0-255范围
-                "best_score": float(best_score),
-                "shape": [int(best_mask.shape[0]), int(best_mask.shape[1])],  # 确保shape也是原生int
+                "best_mask": encoded[best_idx],
+                "mask_encoding": mask_encoding,
+                "format": "mask",
+                "best_score": float(scores[best_idx]),
+                "shape": [int(masks.shape[1]), int(masks.shape[2])],  # 确保shape也是原生int
                 "num_masks": int(len(masks))
             }
             
         except Exception as e:
             return False, str(e), None
     
-    def refine_mask_boundaries(self, mask):
-        """最小化掩码处理，保持原始SAM精度"""
+    def build_polygon_result(self, masks, scores, timings=None):
+        """多边形输出：每个候选掩码只返回简化轮廓、中心点、边界框和面积（掩码已精化）"""
+        timings = timings or RequestTimings()
+        polygon_data = []
+        best_idx = int(np.argmax(scores))
+        
+        with timings.stage("serialization"):
+            for i, (mask, score) in enumerate(zip(masks, scores)):
+                shape_info = mask_to_polygon(mask) or {
+                    "polygon": [], "center": None, "bbox": None, "area": 0
+                }
+                shape_info.update({
+                    "score": float(score),
+                    "is_best": bool(i == best_idx)
+                })
+                polygon_data.append(shape_info)
+        
+        return True, "Prediction successful", {
+            "masks": polygon_data,
+            "best_polygon": polygon_data[best_idx],
+            "format": "polygon",
+            "best_score": float(scores[best_idx]),
+            "shape": [int(masks.shape[1]), int(masks.shape[2])],
+            "num_masks": int(len(masks))
+        }
+    
+    def stream_prediction_result(self, masks, scores, mask_encoding="rle", output_format="mask", refine=True,
+                                 timings=None):
+        """逐个候选生成NDJSON行：最佳掩码先精化先发送，其余按分数降序，最后一行为done
+
+        精化和序列化在生成器中执行，耗时计入 timings（响应开始后才发生）。
+        """
+        timings = timings or RequestTimings()
+        masks = masks > 0
+        shape = [int(masks.shape[1]), int(masks.shape[2])]
+        order = [int(i) for i in np.argsort(-np.asarray(scores), kind="stable")]
+        
         try:
-            # 首先检查掩码是否有效
-            if mask is None or mask.size == 0 or not np.any(mask):
-                print("警告: 掩码为空或无效，返回原始掩码")
-                return mask
-            
-            # 确保掩码是bool类型
-            bool_mask = mask.astype(bool)
-            original_area = np.sum(bool_mask)
-            
-            print(f"掩码精化前面积: {original_area} 像素")
-            
-            # 最小化处理：只移除单像素噪点
-            if original_area > 100:  # 只对足够大的掩码进行清理
-                # 使用最小的kernel只移除孤立像素
-                kernel = np.ones((2,2), np.uint8)
-                uint8_mask = bool_mask.astype(np.uint8) * 255
-                
-                # 很轻微的开运算，只移除明显的噪点
-                cleaned_mask = cv2.morphologyEx(uint8_mask, cv2.MORPH_OPEN, kernel, iterations=1)
-                refined_bool = (cleaned_mask > 0).astype(bool)
-                
-                refined_area = np.sum(refined_bool)
+            # 最佳掩码单独精化，其余候选之后一次处理，尽早发出第一行
+            for group in (order[:1], order[1:]):
+                if not group:
+                    continue
+                group_masks = masks[group]
+                with timings.stage("refinement"):
+                    if refine:
+                        group_masks, areas = self.refine_mask_stack(group_masks)
+                    else:
+                        areas = self.mask_areas(group_masks)
                 
-                # 只接受面积变化很小的结果
-                if refined_area > original_area * 0.8 and refined_area < original_area * 1.2:
-                    print(f"掩码精化后面积: {refined_area} 像素 (变化: {((refined_area/original_area)-1)*100:.1f}%)")
-                    return refined_bool
-                else:
-                    print(f"掩码处理后面积变化过大，保持原始掩码")
-                    return bool_mask
-            else:
-                print(f"掩码面积较小，跳过精化处理")
-                return bool_mask
-            
+                for idx, mask, area in zip(group, group_masks, areas):
+                    serialize_start = time.perf_counter()
+                    line = {
+                        "type": "mask",
+                        "index": idx,
+                        "score": float(scores[idx]),
+                        "is_best": idx == order[0],
+                        "format": output_format,
+                        "shape": shape,
+                    }
+                    if output_format == "polygon":
+                        line.update(mask_to_polygon(mask) or {
+                            "polygon": [], "center": None, "bbox": None, "area": 0
+                        })
+                    else:
+                        line.update({
+                            "mask": encode_mask(mask, mask_encoding),
+                            "mask_encoding": mask_encoding,
+                            "area": int(area),
+                        })
+                    encoded = json.dumps(line).encode("utf-8") + b"\n"
+                    timings.add("serialization", time.perf_counter() - serialize_start)
+                    yield encoded
+        except Exception as e:
+            # 响应头已发出，错误只能作为最后一行返回
+            yield json.dumps({"type": "error", "message": str(e)}).encode("utf-8") + b"\n"
+            return
+        
+        yield json.dumps({
+            "type": "done",
+            "num_masks": len(order),
+            "best_index": order[0],
+            "best_score": float(scores[order[0]]),
+        }).encode("utf-8") + b"\n"
+    
+    def mask_areas(self, masks):
+        """一次归约计算掩码堆栈 (N,H,W) 中每个掩码的面积"""
+        return np.count_nonzero(masks.reshape(len(masks), -1), axis=1)
+    
+    def refine_mask_stack(self, masks):
+        """最小化掩码处理，保持原始SAM精度；对 (N,H,W) 候选堆栈一次完成，返回 (精化掩码, 面积)
+
+        只对面积>100的掩码做2x2开运算移除孤立像素，面积变化超过±20%时保留原始掩码。
+        """
+        masks = np.asarray(masks).astype(bool, copy=False)
+        original_areas = self.mask_areas(masks)
+        candidates = original_areas > 100
+        if not np.any(candidates):
+            return masks, original_areas
+        
+        try:
+            # bool掩码按uint8视图零拷贝送入OpenCV，结果写入同一个预分配的堆栈
+            kernel = np.ones((2, 2), np.uint8)
+            source = np.ascontiguousarray(masks[candidates])
+            opened = np.empty_like(source)
+            for i in range(len(source)):
+                cv2.morphologyEx(source[i].view(np.uint8), cv2.MORPH_OPEN, kernel,
+                                 dst=opened[i].view(np.uint8), iterations=1)
         except Exception as e:
             # 如果精确化失败，返回原始掩码
             print(f"边界精确化失败: {e}")
-            return mask.astype(bool) if hasattr(mask, 'astype') else mask
+            return masks, original_areas
+        
+        refined = masks.copy()
+        refined_areas = original_areas.copy()
+        opened_areas = self.mask_areas(opened)
+        # 只接受面积变化很小的结果
+        accepted = ((opened_areas > original_areas[candidates] * 0.8) &
+                    (opened_areas < original_areas[candidates] * 1.2))
+        candidate_idx = np.flatnonzero(candidates)[accepted]
+        refined[candidate_idx] = opened[accepted]
+        refined_areas[candidate_idx] = opened_areas[accepted]
+        return refined, refined_areas
     
-    def enhance_points_with_color_analysis(self, points, point_labels):
-        """基于颜色分析增强点击点（参考官方演示的预处理）"""
+    def refine_mask_boundaries(self, mask):
+        """单个掩码的边界精化"""
+        if mask is None or mask.size == 0 or not np.any(mask):
+            return mask
+        refined, _ = self.refine_mask_stack(np.asarray(mask)[None])
+        return refined[0]
+    
+    def enhance_points_with_color_analysis(self, color_regions, points, point_labels, max_area_fraction=0.25):
+        """基于颜色分析增强点击点（参考官方演示的预处理）
+
+        正样本点所在色块的轮廓上追加引导点；色块查找和轮廓都来自会话预先计算的颜色连通域，
+        每个点只是一次查表。背景等超过图像 max_area_fraction 的大色块不做增强。
+        """
         try:
-            if not points:
+            if not points or color_regions is None:
                 return points, point_labels
             
+            max_area = max_area_fraction * color_regions.shape[0] * color_regions.shape[1]
             enhanced_points = []
             enhanced_labels = []
             
-            # 获取图像的BGR格式用于OpenCV处理
-            image_bgr = cv2.cvtColor(self.current_image, cv2.COLOR_RGB2BGR)
-            h, w = image_bgr.shape[:2]
-            
-            for i, (point, label) in enumerate(zip(points, point_labels or [1] * len(points))):
-                x, y = int(point[0]), int(point[1])
-                
-                # 确保点在图像范围内
-                if not (0 <= x < w and 0 <= y < h):
-                    enhanced_points.append(point)
-                    enhanced_labels.append(label)
+            for point, label in zip(points, point_labels or [1] * len(points)):
+                enhanced_points.append(point)
+                enhanced_labels.append(label)
+                if label != 1:  # 只对正样本点进行增强
                     continue
                 
-                if label == 1:  # 只对正样本点进行增强
-                    # 获取点击位置的颜色
-                    click_color = image_bgr[y, x]
-                    
-                    # 基于颜色相似度找到色块区域
-                    color_mask = self.find_similar_color_region(image_bgr, click_color, x, y)
-                    
-                    if color_mask is not None and np.any(color_mask):
-                        # 在色块边界上添加额外的引导点
-                        boundary_points = self.extract_boundary_guidance_points(color_mask, x, y)
-                        
-                        # 添加原始点
-                        enhanced_points.append(point)
-                        enhanced_labels.append(label)
-                        
-                        # 添加边界引导点
-                        for bp in boundary_points:
-                            enhanced_points.append(bp)
-                            enhanced_labels.append(1)  # 都是正样本
-                        
-                        print(f"点 ({x},{y}) 增强为 {len(boundary_points)+1} 个点")
-                    else:
-                        enhanced_points.append(point)
-                        enhanced_labels.append(label)
-                else:
-                    # 负样本点直接添加
-                    enhanced_points.append(point)
-                    enhanced_labels.append(label)
+                component = self.find_similar_color_region(color_regions, point[0], point[1])
+                if component and color_regions.areas[component] <= max_area:
+                    # 在色块边界上添加额外的引导点（都是正样本）
+                    for bp in self.extract_boundary_guidance_points(color_regions, component):
+                        enhanced_points.append(bp)
+                        enhanced_labels.append(1)
             
             return enhanced_points, enhanced_labels
             
@@ -198,82 +938,110 @@ class SAMAPIServer:
             print(f"点增强失败: {e}")
             return points, point_labels
     
-    def find_similar_color_region(self, image_bgr, target_color, center_x, center_y):
-        """查找相似颜色的区域"""
-        try:
-            # 颜色容差（可调整）
-            color_tolerance = 30
-            
-            # 创建颜色掩码
-            lower_bound = np.maximum(target_color.astype(int) - color_tolerance, 0)
-            upper_bound = np.minimum(target_color.astype(int) + color_tolerance, 255)
-            
-            color_mask = cv2.inRange(image_bgr, lower_bound, upper_bound)
-            
-            # 形态学操作连接相近的区域
-            kernel = np.ones((5,5), np.uint8)
-            color_mask = cv2.morphologyEx(color_mask, cv2.MORPH_CLOSE, kernel)
-            color_mask = cv2.morphologyEx(color_mask, cv2.MORPH_OPEN, kernel)
-            
-            # 使用泛洪填充确保连通性
-            h, w = image_bgr.shape[:2]
-            flood_mask = np.zeros((h+2, w+2), np.uint8)
-            
-            cv2.floodFill(color_mask, flood_mask, (center_x, center_y), 255)
-            
-            return color_mask > 0
-            
-        except Exception as e:
-            print(f"颜色区域查找失败: {e}")
-            return None
+    def find_similar_color_region(self, color_regions, center_x, center_y):
+        """查找点击位置所在的同色连通域，返回连通域编号（0表示不在任何色块内）"""
+        return color_regions.component_at(center_x, center_y)
     
-    def extract_boundary_guidance_points(self, color_mask, center_x, center_y, max_points=4):
-        """从色块边界提取引导点"""
+    def extract_boundary_guidance_points(self, color_regions, component, max_points=4):
+        """从色块边界（缓存的轮廓）均匀采样引导点"""
         try:
-            # 找到轮廓
-            contours, _ = cv2.findContours(
-                color_mask.astype(np.uint8), 
-                cv2.RETR_EXTERNAL, 
-                cv2.CHAIN_APPROX_SIMPLE
-            )
-            
-            if not contours:
-                return []
-            
-            # 选择包含中心点的最大轮廓
-            target_contour = None
-            for contour in contours:
-                if cv2.pointPolygonTest(contour, (center_x, center_y), False) >= 0:
-                    target_contour = contour
-                    break
-            
-            if target_contour is None:
-                target_contour = max(contours, key=cv2.contourArea)
-            
-            # 从轮廓上均匀采样点
-            contour_points = target_contour.reshape(-1, 2)
-            
-            if len(contour_points) < max_points:
-                return [[int(p[0]), int(p[1])] for p in contour_points]
-            
-            # 均匀采样
-            step = len(contour_points) // max_points
-            sampled_points = []
-            
-            for i in range(0, len(contour_points), step):
-                if len(sampled_points) >= max_points:
-                    break
-                point = contour_points[i]
-                sampled_points.append([int(point[0]), int(point[1])])
-            
-            return sampled_points
-            
+            return color_regions.boundary_points(component, max_points=max_points)
         except Exception as e:
             print(f"边界点提取失败: {e}")
             return []
 
 # 全局SAM实例
 sam_server = None
+# 各接口/阶段延迟直方图，模型加载前也记录HTTP耗时
+latency_metrics = LatencyMetrics()
+sam_server_lock = threading.Lock()
+# SAMAPIServer构造参数，由main()根据命令行设置
+sam_server_options = {}
+# 模型状态：idle -> loading -> loaded（懒加载）或 warming -> ready；加载失败为failed
+model_state = {"status": "idle", "error": None}
+
+def set_model_status(status, error=None):
+    model_state["status"] = status
+    model_state["error"] = error
+
+def model_ready():
+    return model_state["status"] in ("loaded", "ready")
+
+def get_sam_server():
+    """获取（必要时创建）全局SAM实例；加锁避免并发请求重复加载模型"""
+    global sam_server
+    with sam_server_lock:
+        if sam_server is None:
+            set_model_status("loading")
+            try:
+                sam_server = SAMAPIServer(metrics=latency_metrics, **sam_server_options)
+            except Exception as e:
+                set_model_status("failed", str(e))
+                raise
+            set_model_status("loaded")
+        return sam_server
+
+def load_and_warm_up():
+    """加载模型并预热，供后台线程调用"""
+    try:
+        server = get_sam_server()
+    except Exception as e:
+        print(f"SAM model failed to load: {e}")
+        return
+    set_model_status("warming")
+    start = time.time()
+    try:
+        server.warm_up()
+        print(f"SAM model warmed up in {time.time() - start:.2f}s")
+    except Exception as e:
+        # 预热失败不影响模型可用，仅首个请求会慢一些
+        print(f"SAM warm-up failed: {e}")
+    set_model_status("ready")
+
+def start_background_warm_up():
+    """启动时在后台线程加载模型，HTTP服务立即可以响应健康检查"""
+    thread = threading.Thread(target=load_and_warm_up, name="sam-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def model_loading_response():
+    """模型仍在后台加载时返回503"""
+    response = jsonify({"success": False, "message": f"SAM model is {model_state['status']}, retry shortly"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "5"
+    return response
+
+def queue_full_response(e):
+    """推理队列已满时返回503，提示客户端稍后重试"""
+    response = jsonify({"success": False, "message": str(e)})
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+@app.before_request
+def start_request_timing():
+    """API请求开始计时；静态文件不计"""
+    if request.path.startswith('/api/'):
+        g.timings = RequestTimings()
+
+@app.after_request
+def record_request_timing(response):
+    """汇总阶段耗时到直方图，并通过Server-Timing头返回本次请求的耗时"""
+    timings = g.pop('timings', None)
+    if timings is not None:
+        total = timings.elapsed()
+        # 流式响应的正文尚未生成，由 observe_stream 在生成结束后记录；Server-Timing只含响应开始前的阶段
+        if not g.pop('timings_streamed', False):
+            latency_metrics.observe_request(request.endpoint or request.path, timings, total)
+        response.headers["Server-Timing"] = timings.server_timing(total)
+    return response
+
+def observe_stream(lines, timings, endpoint):
+    """包装流式响应的生成器：正文生成结束（或客户端断开）后记录全部阶段和HTTP总耗时"""
+    try:
+        yield from lines
+    finally:
+        latency_metrics.observe_request(endpoint, timings, timings.elapsed())
 
 @app.route('/')
 def index():
@@ -288,28 +1056,148 @@ def serve_files(filename):
 @app.route('/api/init', methods=['POST'])
 def init_sam():
     """初始化SAM"""
-    global sam_server
     try:
         data = request.get_json()
         image_path = data.get('image_path', 'lumine-yurakucho.png')
         
-        if sam_server is None:
-            sam_server = SAMAPIServer()
+        if model_state["status"] in ("loading", "warming"):
+            return model_loading_response()
         
-        success, message = sam_server.set_image(image_path)
+        server = get_sam_server()
+        image_id = data.get('image_id')
+        if image_id:
+            # 已上传的图像：直接从注册表取像素，无需再次读取和解码
+            image_rgb = server.images.image(image_id)
+            if image_rgb is None:
+                return jsonify({"success": False, "message": f"Unknown image_id: {image_id}"}), 404
+            success, message, session = server.open_session(image_rgb, image_id, session_id=data.get('session_id'),
+                                                            timings=g.timings, tiled=data.get('tiled'))
+        else:
+            success, message, session = server.set_image(image_path, session_id=data.get('session_id'),
+                                                          timings=g.timings, tiled=data.get('tiled'))
         
         return jsonify({
             "success": success,
             "message": message,
-            "image_shape": sam_server.current_image.shape if success else None
+            "session_id": session.session_id if success else None,
+            "image_shape": session.image.shape if success else None,
+            "tiles": len(session.tiles) if success and session.tiles is not None else None
         })
+    except InferenceQueueFull as e:
+        return queue_full_response(e)
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 500
+
+def request_image_bytes():
+    """上传请求中的图像字节：multipart表单文件（字段image或第一个文件），否则为原始请求体"""
+    if request.files:
+        upload = request.files.get('image') or next(iter(request.files.values()))
+        return upload.read()
+    return request.get_data()
+
+def resolve_session_id(data):
+    """请求使用的会话：优先session_id，否则按image_id找到该图像的会话（过期时重新打开）"""
+    session_id = data.get('session_id')
+    image_id = data.get('image_id')
+    if session_id or not image_id:
+        return session_id
+    session_id = sam_server.session_for_image(image_id)
+    if session_id is None:
+        raise KeyError(f"Unknown image_id: {image_id}")
+    return session_id
+
+@app.route('/api/images', methods=['POST'])
+def upload_image():
+    """上传图像：按字节和像素哈希去重，只解码一次，返回可直接用于预测的image_id"""
+    try:
+        if model_state["status"] in ("loading", "warming"):
+            return model_loading_response()
+        
+        data = request_image_bytes()
+        if not data:
+            return jsonify({"success": False, "message": "No image data"}), 400
+        
+        server = get_sam_server()
+        tiled = request.args.get('tiled')
+        success, message, session, deduplicated = server.upload_image(
+            data,
+            session_id=request.args.get('session_id'),
+            timings=g.timings,
+            tiled=None if tiled is None else tiled.lower() in ("1", "true", "yes")
+        )
+        if not success:
+            return jsonify({"success": False, "message": message}), 400
+        
+        return jsonify({
+            "success": True,
+            "message": message,
+            "image_id": session.image_hash,
+            "session_id": session.session_id,
+            "image_shape": session.image.shape,
+            "tiles": len(session.tiles) if session.tiles is not None else None,
+            "deduplicated": deduplicated
+        })
+    except InferenceQueueFull as e:
+        return queue_full_response(e)
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
 @app.route('/api/predict', methods=['POST'])
 def predict():
     """SAM预测接口"""
-    global sam_server
+    try:
+        if sam_server is None:
+            return jsonify({"success": False, "message": "SAM not initialized"}), 400
+        
+        data = request.get_json()
+        points = data.get('points', [])
+        boxes = data.get('boxes', [])
+        point_labels = data.get('point_labels', [])
+        mode = data.get('mode', 'sam')
+        
+        if mode == 'color':
+            # 色块模式：查预先计算的连通域，亚毫秒级返回，适合悬停预览
+            success, message, body = sam_server.color_response(
+                points=points if points else None,
+                boxes=boxes if boxes else None,
+                point_labels=point_labels if point_labels else None,
+                session_id=resolve_session_id(data),
+                mask_encoding=data.get('mask_encoding', 'raw'),
+                output_format=data.get('format', 'mask'),
+                timings=g.timings
+            )
+        elif mode in ('sam', 'hybrid'):
+            success, message, body = sam_server.predict_response(
+                points=points if points else None,
+                boxes=boxes if boxes else None,
+                point_labels=point_labels if point_labels else None,
+                session_id=resolve_session_id(data),
+                mask_encoding=data.get('mask_encoding', 'raw'),
+                output_format=data.get('format', 'mask'),
+                incremental=bool(data.get('incremental', False)),
+                refine=bool(data.get('refine', True)),
+                color_guidance=bool(data.get('color_guidance', False)),
+                hybrid=mode == 'hybrid',
+                timings=g.timings
+            )
+        else:
+            return jsonify({"success": False, "message": f"Unknown mode: {mode}"}), 400
+        
+        if success:
+            return app.response_class(body, mimetype='application/json')
+        else:
+            return jsonify({"success": False, "message": message}), 400
+            
+    except InferenceQueueFull as e:
+        return queue_full_response(e)
+    except KeyError as e:
+        return jsonify({"success": False, "message": e.args[0]}), 404
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/api/predict/stream', methods=['POST'])
+def predict_stream():
+    """流式SAM预测接口：NDJSON（application/x-ndjson）逐行返回候选，最佳掩码优先"""
     try:
         if sam_server is None:
             return jsonify({"success": False, "message": "SAM not initialized"}), 400
@@ -319,55 +1207,279 @@ def predict():
         boxes = data.get('boxes', [])
         point_labels = data.get('point_labels', [])
         
-        success, message, result = sam_server.predict(
+        success, message, lines = sam_server.predict_stream(
             points=points if points else None,
             boxes=boxes if boxes else None,
-            point_labels=point_labels if point_labels else None
+            point_labels=point_labels if point_labels else None,
+            session_id=resolve_session_id(data),
+            mask_encoding=data.get('mask_encoding', 'rle'),
+            output_format=data.get('format', 'mask'),
+            incremental=bool(data.get('incremental', False)),
+            refine=bool(data.get('refine', True)),
+            color_guidance=bool(data.get('color_guidance', False)),
+            hybrid=data.get('mode') == 'hybrid',
+            timings=g.timings
         )
         
         if success:
-            return jsonify({
-                "success": True,
-                "message": message,
-                "masks": result["masks"],
-                "best_mask": result["best_mask"],
-                "best_score": result["best_score"],
-                "shape": result["shape"],
-                "num_masks": result["num_masks"],
-                # 向后兼容
-                "mask": result["best_mask"],
-                "score": result["best_score"]
-            })
+            g.timings_streamed = True
+            return app.response_class(observe_stream(lines, g.timings, request.endpoint),
+                                      mimetype='application/x-ndjson')
         else:
             return jsonify({"success": False, "message": message}), 400
             
+    except InferenceQueueFull as e:
+        return queue_full_response(e)
+    except KeyError as e:
+        return jsonify({"success": False, "message": e.args[0]}), 404
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """提交整图自动分割任务：立即返回job_id，结果已缓存时直接完成"""
+    try:
+        if model_state["status"] in ("loading", "warming"):
+            return model_loading_response()
+        
+        data = request.get_json() or {}
+        job = get_sam_server().submit_segmentation_job(
+            image_id=data.get('image_id'),
+            session_id=data.get('session_id'),
+            image_path=data.get('image_path'),
+            params=data.get('params')
+        )
+        payload = dict(job.to_dict(), success=True)
+        return jsonify(payload), (200 if job.status == "done" else 202)
+    except KeyError as e:
+        return jsonify({"success": False, "message": e.args[0]}), 404
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """列出任务及其状态"""
+    if sam_server is None:
+        return jsonify({"success": True, "jobs": []})
+    return jsonify({"success": True, "jobs": [job.to_dict() for job in sam_server.jobs.list()]})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """任务状态和进度"""
+    job = sam_server.jobs.get(job_id) if sam_server else None
+    if job is None:
+        return jsonify({"success": False, "message": f"Unknown job: {job_id}"}), 404
+    return jsonify(dict(job.to_dict(), success=True))
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """任务结果：与 extract_precise_boundaries.py 导出的区域JSON格式相同"""
+    job = sam_server.jobs.get(job_id) if sam_server else None
+    if job is None:
+        return jsonify({"success": False, "message": f"Unknown job: {job_id}"}), 404
+    if job.status != "done":
+        return jsonify(dict(job.to_dict(), success=False, message=f"Job is {job.status}")), 409
+    return jsonify(dict(PreciseMallSegmenter.build_sam_data(job.result, job.image_shape), success=True,
+                        job_id=job.job_id, cached=job.cached))
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """取消任务：排队中的任务不再执行，运行中的任务在当前批次结束后停止"""
+    if sam_server is None or sam_server.jobs.get(job_id) is None:
+        return jsonify({"success": False, "message": f"Unknown job: {job_id}"}), 404
+    cancelled = sam_server.jobs.cancel(job_id)
+    return jsonify({"success": cancelled, "job_id": job_id})
+
+if sock is not None:
+    @sock.route('/api/ws/hover')
+    def hover_socket(ws):
+        """悬停预览：客户端持续发送带seq的提示，服务端丢弃过期提示，只回答最新的"""
+        if sam_server is None:
+            ws.send(json.dumps({"seq": -1, "success": False, "message": "SAM not initialized"}))
+            return
+        run_hover_channel(ws, sam_server)
+
+@app.route('/api/session/<session_id>', methods=['DELETE'])
+def close_session(session_id):
+    """关闭会话"""
+    if sam_server is None:
+        return jsonify({"success": False, "message": "SAM not initialized"}), 400
+    removed = sam_server.sessions.remove(session_id)
+    return jsonify({"success": removed, "session_id": session_id})
+
 @app.route('/api/health', methods=['GET'])
 def health():
-    """健康检查"""
+    """健康检查：live表示进程存活，ready表示模型已加载完成、可以接收流量"""
     return jsonify({
         "status": "healthy",
+        "live": True,
+        "ready": model_ready(),
+        "model_status": model_state["status"],
+        "model_error": model_state["error"],
         "sam_loaded": sam_server is not None,
-        "image_loaded": sam_server.current_image is not None if sam_server else False
+        "image_loaded": len(sam_server.sessions) > 0 if sam_server else False,
+        "embedding_cache": sam_server.embedding_cache.stats() if sam_server else None,
+        "prediction_cache": sam_server.prediction_cache.stats() if sam_server else None,
+        "image_registry": sam_server.images.stats() if sam_server else None,
+        "color_regions": sam_server.color_regions.stats() if sam_server else None,
+        "mask_banks": sam_server.mask_banks.stats() if sam_server else None,
+        "segmentation_jobs": sam_server.jobs.stats() if sam_server else None,
+        "sessions": sam_server.sessions.stats() if sam_server else None,
+        "inference_worker": sam_server.inference_worker.stats() if sam_server else None,
+        "decoder_backend": ("onnx" if sam_server.onnx_decoder else "torch") if sam_server else None,
+        "hover_websocket": sock is not None,
+        "hover_websocket_port": hover_socket_port
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Prometheus文本格式的延迟直方图及缓存/队列状态"""
+    gauges = {"sam_model_ready": ("1 when the SAM model is loaded and warmed up", int(model_ready()))}
+    counters = {}
+    if sam_server is not None:
+        cache_stats = sam_server.embedding_cache.stats()
+        prediction_stats = sam_server.prediction_cache.stats()
+        worker_stats = sam_server.inference_worker.stats()
+        gauges.update({
+            "sam_embedding_cache_hit_rate": ("Embedding cache hit rate", cache_stats["hit_rate"]),
+            "sam_embedding_cache_bytes": ("Embedding cache size in bytes", cache_stats["bytes"]),
+            "sam_prediction_cache_hit_rate": ("Prediction result cache hit rate", prediction_stats["hit_rate"]),
+            "sam_prediction_cache_bytes": ("Prediction result cache size in bytes", prediction_stats["bytes"]),
+            "sam_inference_queue_depth": ("Pending inference jobs", worker_stats["queue_depth"]),
+            "sam_active_sessions": ("Active prediction sessions", len(sam_server.sessions)),
+        })
+        counters.update({
+            "sam_prediction_cache_hits_total": ("Prediction result cache hits", prediction_stats["hits"]),
+            "sam_prediction_cache_misses_total": ("Prediction result cache misses", prediction_stats["misses"]),
+            "sam_inference_rejected_total": ("Inference jobs rejected with 503", worker_stats["rejected"]),
+        })
+    return app.response_class(latency_metrics.render_prometheus(gauges, counters),
+                              mimetype="text/plain; version=0.0.4")
+
+@app.route('/api/health/live', methods=['GET'])
+def health_live():
+    """存活探针：进程能响应即为存活"""
+    return jsonify({"live": True})
+
+@app.route('/api/health/ready', methods=['GET'])
+def health_ready():
+    """就绪探针：模型未就绪时返回503，负载均衡器据此决定是否转发流量"""
+    ready = model_ready()
+    return jsonify({"ready": ready, "model_status": model_state["status"]}), (200 if ready else 503)
+
+def serve_hover_socket(host, port):
+    """在独立端口上用werkzeug服务悬停WebSocket（waitress不支持WebSocket升级），其余路径返回404
+
+    每个WebSocket连接占用一个线程，HTTP请求仍由waitress的固定线程池处理。
+    """
+    global hover_socket_port
+    from werkzeug.exceptions import NotFound
+    from werkzeug.serving import make_server
+    
+    def hover_only(environ, start_response):
+        if environ.get("PATH_INFO") != "/api/ws/hover":
+            return NotFound()(environ, start_response)
+        return app(environ, start_response)
+    
+    server = make_server(host, port, hover_only, threaded=True)
+    hover_socket_port = server.server_port
+    threading.Thread(target=server.serve_forever, name="sam-hover-websocket", daemon=True).start()
+    print(f"Serving hover WebSocket on port {hover_socket_port}")
+    return server
+
+def serve_production(host='0.0.0.0', port=5000, threads=None, ws_port=None):
+    """生产模式：多线程WSGI服务器 + 单个推理线程
+
+    HTTP线程只负责请求解析、静态文件和序列化，模型调用统一经推理队列，
+    因此健康检查和静态资源不会排在编码任务后面。使用线程而非多进程，
+    保证整个服务只加载一份模型。安装flask-sock时悬停WebSocket在独立端口（默认HTTP端口+1）上服务。
+    """
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+    
+    if serve is None:
+        if threads is not None:
+            raise SystemExit("--threads requires waitress (pip install waitress)")
+        from werkzeug.serving import run_simple
+        # 没有waitress时退回werkzeug（每个请求一个线程，线程数不受限），WebSocket与HTTP同一端口
+        print("WARNING: waitress not installed, falling back to the threaded werkzeug development server "
+              "(unbounded HTTP threads). Install waitress for production use.")
+        run_simple(host, port, app, threaded=True, use_reloader=False, use_debugger=False)
+        return
+    
+    if sock is not None:
+        serve_hover_socket(host, ws_port if ws_port is not None else port + 1)
+    threads = threads or 8
+    print(f"Serving with waitress ({threads} HTTP threads)")
+    serve(app, host=host, port=port, threads=threads)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="SAM API Server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--production", action="store_true",
+                        help="使用多线程WSGI服务器，启动时加载模型，关闭调试重载")
+    parser.add_argument("--threads", type=int, default=None, help="生产模式下waitress的HTTP线程数（默认8，需要waitress）")
+    parser.add_argument("--ws-port", type=int, default=None,
+                        help="生产模式下悬停WebSocket的端口（默认HTTP端口+1，需要flask-sock）")
+    parser.add_argument("--checkpoint", default="sam_vit_b_01ec64.pth")
+    parser.add_argument("--max-queue", type=int, default=64, help="推理队列上限，超出返回503")
+    parser.add_argument("--batch-max-wait-ms", type=float, default=5)
+    parser.add_argument("--batch-max-size", type=int, default=8)
+    parser.add_argument("--decoder-backend", choices=["torch", "onnx"], default="torch")
+    parser.add_argument("--quantize-encoder", action="store_true")
+    parser.add_argument("--max-sessions", type=int, default=64,
+                        help="同时保留的会话上限（每次上传/初始化新建一个会话，超出时淘汰最久未使用的会话）")
+    parser.add_argument("--session-ttl", type=int, default=1800, help="闲置会话的过期时间（秒）")
+    parser.add_argument("--auto-masks", action="store_true",
+                        help="初始化后在后台运行自动掩码生成，点击优先查掩码索引（不影响交互请求优先级）")
+    return parser.parse_args(argv)
+
 def main():
+    args = parse_args()
+    sam_server_options.update({
+        "checkpoint_path": args.checkpoint,
+        "max_queue": args.max_queue,
+        "batch_max_wait_ms": args.batch_max_wait_ms,
+        "batch_max_size": args.batch_max_size,
+        "decoder_backend": args.decoder_backend,
+        "quantize_encoder": args.quantize_encoder,
+        "auto_masks": args.auto_masks,
+        "max_sessions": args.max_sessions,
+        "session_ttl": args.session_ttl,
+    })
+    
     print("Starting SAM API Server...")
     print("Features:")
     print("  - Interactive point-based annotation")
     print("  - Bounding box annotation")
     print("  - Real SAM model integration")
     print("  - Web-based interface")
-    print("\nAccess the annotator at: http://localhost:5000")
+    print(f"\nAccess the annotator at: http://localhost:{args.port}")
     print("API endpoints:")
     print("  - POST /api/init - Initialize SAM")
+    print("  - POST /api/images - Upload image bytes (deduplicated, returns image_id)")
     print("  - POST /api/predict - Generate masks")
-    print("  - GET /api/health - Health check")
+    print("  - POST /api/predict/stream - Stream masks as NDJSON (best first)")
+    print("  - WS /api/ws/hover - Hover preview (requires flask-sock)")
+    print("  - POST /api/jobs - Submit whole-image segmentation job (GET /api/jobs/<id>[/result], DELETE to cancel)")
+    print("  - DELETE /api/session/<id> - Close session")
+    print("  - GET /api/metrics - Latency histograms (Prometheus)")
+    print("  - GET /api/health - Health check (/api/health/live, /api/health/ready)")
     print("\n" + "="*50)
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # 后台加载并预热模型；调试模式下只在重载器子进程中加载，避免加载两份
+    if args.production or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_warm_up()
+    
+    if args.production:
+        serve_production(host=args.host, port=args.port, threads=args.threads, ws_port=args.ws_port)
+    else:
+        app.run(host=args.host, port=args.port, debug=True)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
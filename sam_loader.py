@@ -0,0 +1,43 @@
+import os
+
+import torch
+from segment_anything import sam_model_registry
+
+
+def quantized_encoder_path(checkpoint_path):
+    """量化后的图像编码器缓存文件放在checkpoint旁边"""
+    base = os.path.splitext(checkpoint_path or "sam_vit_b")[0]
+    return f"{base}_encoder_int8.pt"
+
+
+def embedding_variant(model_type, quantize_encoder=False):
+    """嵌入缓存/存储使用的模型标识：量化编码器的嵌入与float32不同，需分开存放"""
+    return f"{model_type}_int8" if quantize_encoder else model_type
+
+
+def quantize_image_encoder(sam, cache_path=None):
+    """对图像编码器的Linear层做动态int8量化（仅支持CPU）"""
+    sam.to(device="cpu")
+    encoder = torch.ao.quantization.quantize_dynamic(
+        sam.image_encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+    if cache_path and os.path.exists(cache_path):
+        # 复用已缓存的量化权重，保证多个进程得到完全一致的编码器
+        encoder.load_state_dict(torch.load(cache_path, map_location="cpu"))
+    elif cache_path:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        torch.save(encoder.state_dict(), tmp_path)
+        os.replace(tmp_path, cache_path)
+        print(f"Quantized image encoder cached to {cache_path}")
+
+    sam.image_encoder = encoder
+    return sam
+
+
+def build_sam(checkpoint_path="sam_vit_b_01ec64.pth", model_type="vit_b", quantize_encoder=False):
+    """加载SAM模型，可选int8动态量化图像编码器"""
+    sam = sam_model_registry[model_type](checkpoint=checkpoint_path)
+    if quantize_encoder:
+        sam = quantize_image_encoder(sam, cache_path=quantized_encoder_path(checkpoint_path))
+    return sam
@@ -1,15 +1,16 @@
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from segment_anything import SamAutomaticMaskGenerator, SamPredictor
+from sam_loader import build_sam
 import json
 from PIL import Image, ImageDraw
 
 class MallMapSegmenter:
-    def __init__(self, checkpoint_path="sam_vit_b_01ec64.pth"):
-        """Initialize the SAM model"""
+    def __init__(self, checkpoint_path="sam_vit_b_01ec64.pth", quantize_encoder=False):
+        """Initialize the SAM model (optionally with an int8 quantized image encoder)"""
         print("Loading SAM model...")
-        self.sam = sam_model_registry["vit_b"](checkpoint=checkpoint_path)
+        self.sam = build_sam(checkpoint_path, quantize_encoder=quantize_encoder)
         self.mask_generator = SamAutomaticMaskGenerator(self.sam)
         self.predictor = SamPredictor(self.sam)
         
@@ -0,0 +1,188 @@
+import json
+import queue
+import threading
+import time
+import uuid
+
+from embedding_cache import EmbeddingCache
+from extract_precise_boundaries import PRECISE_GENERATOR_PARAMS
+
+# 影响生成结果的参数；points_per_batch 只影响调度粒度，不参与缓存键
+JOB_PARAM_TYPES = {
+    "points_per_side": int,
+    "pred_iou_thresh": float,
+    "stability_score_thresh": float,
+    "crop_n_layers": int,
+    "crop_n_points_downscale_factor": int,
+    "min_mask_region_area": int,
+    "box_nms_thresh": float,
+    "crop_nms_thresh": float,
+}
+
+
+class JobCancelled(Exception):
+    """任务已被客户端取消"""
+
+
+def normalize_job_params(params=None):
+    """合并默认参数（与 PreciseMallSegmenter 相同）并校验类型，未知参数直接报错"""
+    normalized = dict(PRECISE_GENERATOR_PARAMS)
+    for name, value in (params or {}).items():
+        if name not in JOB_PARAM_TYPES:
+            raise ValueError(f"Unknown generator parameter: {name}")
+        normalized[name] = JOB_PARAM_TYPES[name](value)
+    return normalized
+
+
+def job_cache_key(model, image_hash, params):
+    """结果缓存键：(模型, 图像哈希, 排序后的生成参数)"""
+    return (model, image_hash, tuple(sorted(params.items())))
+
+
+class SegmentationJob:
+    def __init__(self, image_hash, params, cache_key, image_shape):
+        """一次自动分割任务：状态 queued -> running -> done / failed / cancelled"""
+        self.job_id = uuid.uuid4().hex
+        self.image_hash = image_hash
+        self.params = params
+        self.cache_key = cache_key
+        self.image_shape = image_shape
+        self.status = "queued"
+        self.processed = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.cached = False
+        self.cancel_requested = False
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def update_progress(self, processed, total):
+        """生成器每个批次后回调；已取消时抛出 JobCancelled 终止生成"""
+        self.processed = processed
+        self.total = total
+        if self.cancel_requested:
+            raise JobCancelled("Job cancelled")
+
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def to_dict(self):
+        elapsed_end = self.finished_at or time.time()
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "image_id": self.image_hash,
+            "params": self.params,
+            "progress": {"processed": self.processed, "total": self.total,
+                         "fraction": (self.processed / self.total) if self.total else (1.0 if self.status == "done" else 0.0)},
+            "cached": self.cached,
+            "num_polygons": len(self.result) if self.result is not None else None,
+            "error": self.error,
+            "elapsed": (elapsed_end - self.started_at) if self.started_at else 0.0,
+        }
+
+
+class JobResultCache(EmbeddingCache):
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """自动分割结果缓存（按图像哈希+生成参数），条目为过滤后的多边形列表"""
+        super().__init__(max_bytes=max_bytes)
+
+    def entry_bytes(self, entry):
+        return len(json.dumps(entry["polygons"]))
+
+
+class JobManager:
+    def __init__(self, run_job, max_jobs=256, result_cache_max_bytes=64 * 1024 * 1024):
+        """自动分割任务队列：任务在单个后台线程中依次执行
+
+        run_job(job, image_rgb, embedding) 返回多边形列表；模型计算应以低优先级提交给推理线程，
+        保证交互请求优先。相同图像+参数的结果命中缓存时任务直接完成，进行中的相同任务直接复用。
+        """
+        self.run_job = run_job
+        self.max_jobs = max_jobs
+        self.results = JobResultCache(max_bytes=result_cache_max_bytes)
+        self._jobs = {}
+        self._active = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="sam-segmentation-jobs", daemon=True)
+        self._worker.start()
+
+    def submit(self, image_rgb, image_hash, params, model, embedding=None):
+        """提交任务，返回 SegmentationJob（可能已完成）"""
+        cache_key = job_cache_key(model, image_hash, params)
+        with self._lock:
+            active = self._active.get(cache_key)
+            if active is not None:
+                return active
+
+            job = SegmentationJob(image_hash, params, cache_key, image_rgb.shape[:2])
+            cached = self.results.get(cache_key)
+            if cached is not None:
+                job.status = "done"
+                job.cached = True
+                job.result = cached["polygons"]
+                job.processed = job.total = cached["total"]
+                job.started_at = job.finished_at = time.time()
+            else:
+                self._active[cache_key] = job
+                self._queue.put((job, image_rgb, embedding))
+            self._remember_locked(job)
+            return job
+
+    def _remember_locked(self, job):
+        self._jobs[job.job_id] = job
+        # 超过上限时丢弃最早完成的任务记录（结果仍在缓存中）
+        while len(self._jobs) > self.max_jobs:
+            finished = [j for j in self._jobs.values() if j.finished()]
+            if not finished:
+                break
+            del self._jobs[min(finished, key=lambda j: j.created_at).job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created_at)
+
+    def cancel(self, job_id):
+        """请求取消任务；排队中的任务不会开始，运行中的任务在下一批次后停止"""
+        job = self.get(job_id)
+        if job is None or job.finished():
+            return False
+        job.cancel_requested = True
+        return True
+
+    def stats(self):
+        with self._lock:
+            statuses = {}
+            for job in self._jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {"jobs": statuses, "queued": self._queue.qsize(), "results": self.results.stats()}
+
+    def _run(self):
+        while True:
+            job, image_rgb, embedding = self._queue.get()
+            try:
+                if job.cancel_requested:
+                    raise JobCancelled("Job cancelled")
+                job.status = "running"
+                job.started_at = time.time()
+                polygons = self.run_job(job, image_rgb, embedding)
+                self.results.put(job.cache_key, {"polygons": polygons, "total": job.total})
+                job.result = polygons
+                job.status = "done"
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                job.error = str(e)
+                job.status = "failed"
+                print(f"自动分割任务失败 {job.job_id}: {e}")
+            finally:
+                job.finished_at = time.time()
+                with self._lock:
+                    self._active.pop(job.cache_key, None)
@@ -0,0 +1,106 @@
+import threading
+import time
+import uuid
+
+
+class SAMSession:
+    def __init__(self, session_id, image_rgb, image_hash, embedding, tiles=None):
+        """单个客户端的预测会话：图像及其嵌入（瓦片模式下embedding为None，嵌入按瓦片保存在tiles中）"""
+        self.session_id = session_id
+        self.image = image_rgb
+        self.image_hash = image_hash
+        self.embedding = embedding
+        self.tiles = tiles
+        # 量化颜色连通域（ColorRegionMap），由服务端在打开会话时设置
+        self.color_regions = None
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.reset_prompt()
+
+    def touch(self):
+        """刷新最近访问时间"""
+        self.last_access = time.time()
+
+    def reset_prompt(self):
+        """清空当前对象的累积提示和低分辨率logits"""
+        self.prompt_points = []
+        self.prompt_labels = []
+        self.prompt_boxes = []
+        self.mask_logits = None
+
+    def has_prompt(self):
+        """是否有上一轮累积的提示（增量请求会在其基础上追加）"""
+        return bool(self.prompt_points or self.prompt_boxes) or self.mask_logits is not None
+
+    def update_prompt(self, points, point_labels, boxes, mask_logits):
+        """记录本次预测的完整提示及最佳候选的低分辨率logits（1x256x256，瓦片模式为None）"""
+        self.prompt_points = list(points or [])
+        self.prompt_labels = list(point_labels or [])
+        self.prompt_boxes = list(boxes or [])
+        self.mask_logits = mask_logits
+
+
+class SessionManager:
+    def __init__(self, ttl_seconds=1800, max_sessions=64):
+        """会话管理器：闲置超过TTL的会话会被淘汰"""
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.expired = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, image_rgb, image_hash, embedding, session_id=None, tiles=None):
+        """创建会话；传入已有session_id时替换该会话的图像"""
+        session_id = session_id or uuid.uuid4().hex
+        session = SAMSession(session_id, image_rgb, image_hash, embedding, tiles=tiles)
+        with self._lock:
+            self._evict_expired_locked()
+            self._sessions[session_id] = session
+            # 超过上限时淘汰最久未访问的会话
+            while len(self._sessions) > self.max_sessions:
+                oldest_id = min(self._sessions, key=lambda sid: self._sessions[sid].last_access)
+                del self._sessions[oldest_id]
+                self.expired += 1
+        return session
+
+    def get(self, session_id):
+        """获取会话并刷新访问时间，不存在或已过期时返回None"""
+        with self._lock:
+            self._evict_expired_locked()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.touch()
+            return session
+
+    def remove(self, session_id):
+        """关闭会话"""
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def evict_expired(self):
+        """淘汰所有闲置超时的会话"""
+        with self._lock:
+            return self._evict_expired_locked()
+
+    def _evict_expired_locked(self):
+        now = time.time()
+        expired_ids = [sid for sid, session in self._sessions.items()
+                       if now - session.last_access > self.ttl_seconds]
+        for sid in expired_ids:
+            del self._sessions[sid]
+        self.expired += len(expired_ids)
+        return len(expired_ids)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def stats(self):
+        """返回会话统计"""
+        with self._lock:
+            return {
+                "active": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl_seconds": self.ttl_seconds,
+                "expired": self.expired,
+            }
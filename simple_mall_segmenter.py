@@ -1,9 +1,16 @@
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 import json
-from PIL import Image, ImageDraw
-from sklearn.cluster import KMeans
+
+# Color ranges for the store categories (RGB lower/upper, based on actual image analysis)
+STORE_COLOR_RANGES = {
+    # Pink areas (ladies fashion) - RGB(225, 207, 217)
+    "pink": (np.array([210, 190, 200]), np.array([240, 220, 235])),
+    # Light blue/gray areas (interior/lifestyle) - RGB(203, 212, 216)
+    "blue": (np.array([190, 200, 200]), np.array([220, 225, 230])),
+    # Light green areas (fashion accessories) - similar to pink but more green
+    "green": (np.array([210, 180, 190]), np.array([235, 210, 220])),
+}
 
 class SimpleMallMapSegmenter:
     def __init__(self):
@@ -16,32 +23,32 @@ class SimpleMallMapSegmenter:
         image = cv2.imread(image_path)
         image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         
-        # Define color ranges for different store categories (based on actual image analysis)
-        # Pink areas (ladies fashion) - RGB(225, 207, 217)
-        pink_lower = np.array([210, 190, 200])
-        pink_upper = np.array([240, 220, 235])
-        
-        # Light blue/gray areas (interior/lifestyle) - RGB(203, 212, 216)  
-        blue_lower = np.array([190, 200, 200])
-        blue_upper = np.array([220, 225, 230])
-        
-        # Light green areas (fashion accessories) - similar to pink but more green
-        green_lower = np.array([210, 180, 190])
-        green_upper = np.array([235, 210, 220])
-        
         # Create masks for each color
-        pink_mask = cv2.inRange(image_rgb, pink_lower, pink_upper)
-        blue_mask = cv2.inRange(image_rgb, blue_lower, blue_upper)
-        green_mask = cv2.inRange(image_rgb, green_lower, green_upper)
+        color_masks = self.store_color_masks(image_rgb)
         
         # Find contours for each mask
-        pink_contours = self.find_store_contours(pink_mask)
-        blue_contours = self.find_store_contours(blue_mask)
-        green_contours = self.find_store_contours(green_mask)
+        pink_contours = self.find_store_contours(color_masks["pink"])
+        blue_contours = self.find_store_contours(color_masks["blue"])
+        green_contours = self.find_store_contours(color_masks["green"])
         
         return image_rgb, pink_contours, blue_contours, green_contours
     
-    def find_store_contours(self, mask):
+    @staticmethod
+    def store_color_masks(image_rgb):
+        """inRange mask (0/255) for each store color category"""
+        return {name: cv2.inRange(image_rgb, lower, upper) for name, (lower, upper) in STORE_COLOR_RANGES.items()}
+    
+    @staticmethod
+    def store_area_mask(image_rgb):
+        """Union of all store areas (contours filled, so labels inside a store are included)"""
+        mask = np.zeros(image_rgb.shape[:2], dtype=np.uint8)
+        for color_mask in SimpleMallMapSegmenter.store_color_masks(image_rgb).values():
+            contours = [c['contour'] for c in SimpleMallMapSegmenter.find_store_contours(color_mask)]
+            cv2.drawContours(mask, contours, -1, 1, cv2.FILLED)
+        return mask.astype(bool)
+    
+    @staticmethod
+    def find_store_contours(mask):
         """Find and filter contours for store areas"""
         # Clean up the mask
         kernel = np.ones((3, 3), np.uint8)
@@ -142,6 +149,7 @@ class SimpleMallMapSegmenter:
     def save_results(self, image, pink_contours, blue_contours, green_contours, store_data, output_dir="output"):
         """Save segmentation results and interactive data"""
         import os
+        import matplotlib.pyplot as plt
         os.makedirs(output_dir, exist_ok=True)
         
         # Save original image
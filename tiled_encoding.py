@@ -0,0 +1,129 @@
+import threading
+
+import numpy as np
+
+from embedding_cache import compute_image_hash
+from session_manager import SAMSession
+
+TILE_SIZE = 1024
+TILE_OVERLAP = 256
+
+
+def tile_starts(length, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """单个坐标轴上的瓦片起点：保证至少overlap像素重叠的最少瓦片数，起点均匀分布并与两端对齐"""
+    if length <= tile_size:
+        return [0]
+    count = int(np.ceil((length - overlap) / float(tile_size - overlap)))
+    return [int(round(start)) for start in np.linspace(0, length - tile_size, count)]
+
+
+def core_bounds(starts, length, tile_size=TILE_SIZE):
+    """每块瓦片的核心区间：重叠区从中线分给两侧瓦片，拼接时每个像素只取一块瓦片"""
+    ends = [min(start + tile_size, length) for start in starts]
+    bounds = []
+    for i, start in enumerate(starts):
+        lo = 0 if i == 0 else (start + ends[i - 1]) // 2
+        hi = length if i == len(starts) - 1 else (starts[i + 1] + ends[i]) // 2
+        bounds.append((lo, hi))
+    return bounds
+
+
+class Tile:
+    def __init__(self, index, y0, x0, y1, x1, core):
+        """瓦片在原图中的范围 [y0:y1, x0:x1] 及核心区 (cy0, cx0, cy1, cx1)"""
+        self.index = index
+        self.y0, self.x0, self.y1, self.x1 = y0, x0, y1, x1
+        self.core = core
+
+    def contains(self, x, y):
+        return self.x0 <= x < self.x1 and self.y0 <= y < self.y1
+
+    def center_distance(self, x, y):
+        return np.hypot(x - (self.x0 + self.x1) / 2.0, y - (self.y0 + self.y1) / 2.0)
+
+
+class TiledImage:
+    def __init__(self, image_rgb, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+        """大图按重叠瓦片切分，瓦片嵌入在首次被点击覆盖时才编码"""
+        self.image = image_rgb
+        self.tile_size = tile_size
+        self.overlap = overlap
+        height, width = image_rgb.shape[:2]
+        self.shape = (height, width)
+
+        ys, xs = tile_starts(height, tile_size, overlap), tile_starts(width, tile_size, overlap)
+        y_cores, x_cores = core_bounds(ys, height, tile_size), core_bounds(xs, width, tile_size)
+        self.tiles = []
+        for y0, (cy0, cy1) in zip(ys, y_cores):
+            for x0, (cx0, cx1) in zip(xs, x_cores):
+                self.tiles.append(Tile(len(self.tiles), y0, x0, min(y0 + tile_size, height),
+                                       min(x0 + tile_size, width), (cy0, cx0, cy1, cx1)))
+
+        self._tile_sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def encoded_count(self):
+        with self._lock:
+            return len(self._tile_sessions)
+
+    def tile_session(self, tile, load_embedding):
+        """获取瓦片的预测会话，首次访问时经 load_embedding 编码（按瓦片像素哈希缓存）"""
+        with self._lock:
+            session = self._tile_sessions.get(tile.index)
+        if session is not None:
+            return session
+
+        tile_rgb = np.ascontiguousarray(self.image[tile.y0:tile.y1, tile.x0:tile.x1])
+        tile_hash = compute_image_hash(tile_rgb)
+        embedding, _ = load_embedding(tile_rgb, tile_hash)
+        session = SAMSession(None, tile_rgb, tile_hash, embedding)
+        with self._lock:
+            return self._tile_sessions.setdefault(tile.index, session)
+
+    def tiles_for_prompt(self, points=None, point_labels=None, boxes=None):
+        """覆盖提示的瓦片：包含任一正样本点（或框中心）的瓦片，离提示中心最近的排在最前"""
+        anchors = [point for point, label in zip(points or [], point_labels or []) if label == 1]
+        for box in boxes or []:
+            anchors.append([(box[0] + box[2]) / 2.0, (box[1] + box[3]) / 2.0])
+        if not anchors:
+            anchors = list(points or [])
+        if not anchors:
+            return []
+
+        cx, cy = np.mean(np.asarray(anchors, dtype=np.float64), axis=0)
+        covering = [tile for tile in self.tiles if any(tile.contains(x, y) for x, y in anchors)]
+        return sorted(covering, key=lambda tile: tile.center_distance(cx, cy))
+
+    def tile_prompt(self, tile, points=None, point_labels=None, boxes=None):
+        """把原图坐标的提示转换到瓦片坐标，丢弃瓦片外的点，框裁剪到瓦片范围"""
+        tile_points, tile_labels = [], []
+        for (x, y), label in zip(points or [], point_labels or []):
+            if tile.contains(x, y):
+                tile_points.append([x - tile.x0, y - tile.y0])
+                tile_labels.append(label)
+
+        tile_boxes = []
+        for x0, y0, x1, y1 in boxes or []:
+            bx0, by0 = max(x0, tile.x0), max(y0, tile.y0)
+            bx1, by1 = min(x1, tile.x1 - 1), min(y1, tile.y1 - 1)
+            if bx1 > bx0 and by1 > by0:
+                tile_boxes.append([bx0 - tile.x0, by0 - tile.y0, bx1 - tile.x0, by1 - tile.y0])
+        return tile_points, tile_labels, tile_boxes
+
+    def paste(self, canvas, tile, tile_masks):
+        """把瓦片掩码的核心区写入原图尺寸的画布 (N, H, W)"""
+        cy0, cx0, cy1, cx1 = tile.core
+        canvas[:, cy0:cy1, cx0:cx1] = tile_masks[:, cy0 - tile.y0:cy1 - tile.y0, cx0 - tile.x0:cx1 - tile.x0] > 0
+
+    def expansion_point(self, tile, best_mask):
+        """掩码延伸进未解码瓦片时，取瓦片内离其中心最近的掩码像素作为该瓦片的正样本点"""
+        window = best_mask[tile.y0:tile.y1, tile.x0:tile.x1]
+        ys, xs = np.nonzero(window)
+        if len(xs) == 0:
+            return None
+        center_x, center_y = (tile.x1 - tile.x0) / 2.0, (tile.y1 - tile.y0) / 2.0
+        nearest = int(np.argmin((xs - center_x) ** 2 + (ys - center_y) ** 2))
+        return [int(xs[nearest]) + tile.x0, int(ys[nearest]) + tile.y0]
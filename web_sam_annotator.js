@@ -25,19 +25,28 @@ class WebSAMAnnotator {
         await this.initializeSAM();
     }
     
-    async initializeSAM() {
+    async initializeSAM(maxRetries = 60) {
         try {
             this.updateStatus('正在初始化SAM模型...', 'info');
-            const response = await fetch('/api/init', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ image_path: 'lumine-yurakucho.png' })
-            });
+            let response;
+            for (let attempt = 0; ; attempt++) {
+                response = await fetch('/api/init', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ image_path: 'lumine-yurakucho.png' })
+                });
+                // 模型仍在后台加载/预热（或推理队列已满）时服务端返回503，按Retry-After等待后重试
+                if (response.status !== 503 || attempt >= maxRetries) break;
+                const retryAfter = parseFloat(response.headers.get('Retry-After')) || 5;
+                this.updateStatus(`SAM模型加载中，${retryAfter}秒后重试...`, 'info');
+                await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+            }
             
             const result = await response.json();
             if (result.success) {
                 this.updateStatus('SAM模型初始化完成！开始标注吧。', 'success');
                 this.samInitialized = true;
+                this.sessionId = result.session_id;
             } else {
                 this.updateStatus(`SAM初始化失败: ${result.message}`, 'error');
                 this.samInitialized = false;
@@ -64,6 +73,7 @@ class WebSAMAnnotator {
         this.canvas.addEventListener('mousemove', (e) => this.onCanvasMouseMove(e));
         this.canvas.addEventListener('mouseup', (e) => this.onCanvasMouseUp(e));
         this.canvas.addEventListener('mousemove', (e) => this.updateCoordinateDisplay(e));
+        this.canvas.addEventListener('mouseleave', () => this.clearHoverPreview());
         
         // 阻止右键菜单
         this.canvas.addEventListener('contextmenu', (e) => e.preventDefault());
@@ -115,6 +125,11 @@ class WebSAMAnnotator {
             this.drawMask(this.currentMask, 'rgba(255, 255, 0, 0.5)');
         }
         
+        // 绘制悬停预览
+        if (this.hoverPolygon && this.hoverPolygon.length > 2) {
+            this.drawHoverPolygon(this.hoverPolygon);
+        }
+        
         // 绘制已保存的标注
         this.drawAnnotations();
     }
@@ -408,9 +423,119 @@ class WebSAMAnnotator {
             this.ctx.setLineDash([5, 5]);
             this.ctx.strokeRect(x, y, width, height);
             this.ctx.setLineDash([]);
+        } else if (this.hoverPreviewEnabled && this.currentMode === 'point') {
+            const rect = this.canvas.getBoundingClientRect();
+            this.sendHoverPrompt((e.clientX - rect.left) / this.scale, (e.clientY - rect.top) / this.scale);
+        }
+    }
+    
+    // 悬停预览：通过WebSocket发送带序号的提示，服务端丢弃过期提示，只回答最新的
+    setHoverPreview(enabled) {
+        this.hoverPreviewEnabled = enabled;
+        if (enabled) {
+            this.connectHoverSocket();
+        } else {
+            if (this.hoverSocket) {
+                this.hoverSocket.close();
+            }
+            this.clearHoverPreview();
+        }
+    }
+    
+    async connectHoverSocket() {
+        if (this.hoverSocket) return;
+        
+        // 生产模式下WebSocket在独立端口上服务，端口由 /api/health 给出
+        let port = window.location.port;
+        try {
+            const health = await (await fetch('/api/health')).json();
+            if (health.hover_websocket_port) {
+                port = health.hover_websocket_port;
+            }
+        } catch (error) {
+            console.warn('获取悬停预览端口失败，使用当前端口:', error);
+        }
+        if (this.hoverSocket || !this.hoverPreviewEnabled) return;
+        
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const host = port ? `${window.location.hostname}:${port}` : window.location.hostname;
+        this.hoverSocket = new WebSocket(`${protocol}//${host}/api/ws/hover`);
+        this.hoverSeq = 0;
+        this.hoverRenderedSeq = 0;
+        this.hoverSocket.onmessage = (event) => this.onHoverResult(JSON.parse(event.data));
+        this.hoverSocket.onclose = () => {
+            this.hoverSocket = null;
+        };
+        this.hoverSocket.onerror = () => {
+            this.updateStatus('悬停预览不可用（服务端未安装flask-sock）', 'error');
+        };
+    }
+    
+    sendHoverPrompt(x, y) {
+        if (!this.samInitialized || !this.hoverSocket || this.hoverSocket.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        
+        // 每个动画帧最多发送一次最新的光标位置
+        this.pendingHoverPoint = [Math.round(x), Math.round(y)];
+        if (this.hoverFrameRequested) return;
+        this.hoverFrameRequested = true;
+        
+        requestAnimationFrame(() => {
+            this.hoverFrameRequested = false;
+            if (!this.hoverSocket || this.hoverSocket.readyState !== WebSocket.OPEN) return;
+            
+            this.hoverSeq += 1;
+            this.hoverSocket.send(JSON.stringify({
+                seq: this.hoverSeq,
+                session_id: this.sessionId,
+                points: [this.pendingHoverPoint],
+                point_labels: [1],
+                format: 'polygon',
+                // 纯色色块直接由预计算的连通域回答，其余位置服务端回退到SAM
+                mode: 'color'
+            }));
+        });
+    }
+    
+    onHoverResult(result) {
+        // 忽略比已显示结果更旧的回答
+        if (!result.success || result.seq <= this.hoverRenderedSeq || !this.hoverPreviewEnabled) {
+            return;
+        }
+        this.hoverRenderedSeq = result.seq;
+        this.hoverPolygon = result.polygon;
+        this.drawImage();
+    }
+    
+    clearHoverPreview() {
+        if (this.hoverPolygon) {
+            this.hoverPolygon = null;
+            this.drawImage();
         }
     }
     
+    drawHoverPolygon(polygon) {
+        this.ctx.save();
+        this.ctx.beginPath();
+        polygon.forEach((point, index) => {
+            const x = point.x * this.scale;
+            const y = point.y * this.scale;
+            if (index === 0) {
+                this.ctx.moveTo(x, y);
+            } else {
+                this.ctx.lineTo(x, y);
+            }
+        });
+        this.ctx.closePath();
+        this.ctx.fillStyle = 'rgba(33, 150, 243, 0.25)';
+        this.ctx.fill();
+        this.ctx.strokeStyle = 'rgba(33, 150, 243, 0.9)';
+        this.ctx.lineWidth = 2;
+        this.ctx.stroke();
+        this.ctx.restore();
+    }
+    
     onCanvasMouseUp(e) {
         if (this.currentMode === 'box' && this.isDrawingBox && this.boxStart) {
             const rect = this.canvas.getBoundingClientRect();
@@ -503,6 +628,7 @@ class WebSAMAnnotator {
         this.currentPoints = [];
         this.currentBoxes = [];
         this.currentMask = null;
+        this.sentPointCount = 0;
         
         this.updateCurrentInputsDisplay();
         this.drawImage();
@@ -587,7 +713,7 @@ class WebSAMAnnotator {
             this.currentMask = {
                 width: width,
                 height: height,
-                data: new Uint8Array(selectedMask.mask.flat()),
+                data: decodeMaskPayload(selectedMask.mask, [height, width]),
                 score: selectedMask.score,
                 area: selectedMask.area
             };
@@ -1014,11 +1140,18 @@ async function simulateSAM() {
     
     try {
         // 准备数据
-        const requestData = {};
-        
-        if (annotator.currentPoints.length > 0) {
-            requestData.points = annotator.currentPoints.map(p => [p.x, p.y]);
-            requestData.point_labels = annotator.currentPoints.map(p => p.label);
+        const requestData = { session_id: annotator.sessionId, mask_encoding: 'rle' };
+        
+        // 已经预测过的对象只发送新增点，服务端复用上一轮的低分辨率logits继续细化
+        const sentCount = annotator.sentPointCount || 0;
+        const incremental = annotator.currentBoxes.length === 0 &&
+            sentCount > 0 && annotator.currentPoints.length > sentCount;
+        const newPoints = incremental ? annotator.currentPoints.slice(sentCount) : annotator.currentPoints;
+        requestData.incremental = incremental;
+        
+        if (newPoints.length > 0) {
+            requestData.points = newPoints.map(p => [p.x, p.y]);
+            requestData.point_labels = newPoints.map(p => p.label);
         }
         
         if (annotator.currentBoxes.length > 0) {
@@ -1028,42 +1161,53 @@ async function simulateSAM() {
         }
         
         if (annotator.samInitialized) {
-            // 调用真实的SAM API
-            const response = await fetch('/api/predict', {
+            // 调用流式SAM API：最佳掩码先到先显示，其余候选陆续加入选择器
+            const response = await fetch('/api/predict/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify(requestData)
             });
             
-            const result = await response.json();
+            if (!response.ok) {
+                const result = await response.json();
+                throw new Error(result.message);
+            }
             
-            if (result.success) {
-                // 处理SAM返回的多掩码结果（参考官方演示）
-                if (result.masks && result.masks.length > 0) {
-                    annotator.allMasks = result.masks;
-                    annotator.currentMaskIndex = 0;
-                    
-                    // 使用最佳掩码
-                    const bestMaskData = result.masks.find(m => m.is_best) || result.masks[0];
-                    const [height, width] = result.shape;
-                    
-                    annotator.currentMask = {
-                        width: width,
-                        height: height,
-                        data: new Uint8Array(bestMaskData.mask.flat()),
-                        score: bestMaskData.score,
-                        area: bestMaskData.area
-                    };
+            annotator.allMasks = [];
+            annotator.currentMaskIndex = 0;
+            
+            await readNdjsonStream(response, (line) => {
+                if (line.type === 'error') {
+                    throw new Error(line.message);
+                }
+                
+                if (line.type === 'mask') {
+                    annotator.allMasks.push(line);
                     
-                    annotator.drawImage();
-                    annotator.showMaskSelector(result.masks, result.shape);
-                    annotator.updateStatus(`SAM生成${result.num_masks}个掩码候选！当前: ${bestMaskData.score.toFixed(3)}`, 'success');
-                    document.getElementById('saveBtn').disabled = false;
-                } else {
-                    throw new Error('无效的掩码数据');
+                    if (annotator.allMasks.length === 1) {
+                        // 第一行即最佳掩码，立即渲染
+                        const [height, width] = line.shape;
+                        annotator.sentPointCount = annotator.currentPoints.length;
+                        annotator.currentMask = {
+                            width: width,
+                            height: height,
+                            data: decodeMaskPayload(line.mask, line.shape),
+                            score: line.score,
+                            area: line.area
+                        };
+                        annotator.drawImage();
+                        document.getElementById('saveBtn').disabled = false;
+                    }
+                    annotator.showMaskSelector(annotator.allMasks, line.shape);
                 }
-            } else {
-                throw new Error(result.message);
+                
+                if (line.type === 'done') {
+                    annotator.updateStatus(`SAM生成${line.num_masks}个掩码候选！当前: ${line.best_score.toFixed(3)}`, 'success');
+                }
+            });
+            
+            if (annotator.allMasks.length === 0) {
+                throw new Error('无效的掩码数据');
             }
         } else {
             // 回退到模拟模式
@@ -1077,6 +1221,63 @@ async function simulateSAM() {
     }
 }
 
+// 逐行读取NDJSON流式响应，每解析出一行调用一次onLine
+async function readNdjsonStream(response, onLine) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.filter(line => line.trim()).forEach(line => onLine(JSON.parse(line)));
+    }
+    
+    if (buffer.trim()) {
+        onLine(JSON.parse(buffer));
+    }
+}
+
+// 解码服务器返回的掩码（COCO RLE / 位打包 / 旧版嵌套数组），输出行优先的0/255数组
+function decodeMaskPayload(payload, shape) {
+    const [height, width] = shape;
+    
+    if (Array.isArray(payload)) {
+        return new Uint8Array(payload.flat());
+    }
+    
+    const data = new Uint8Array(width * height);
+    
+    if (payload.counts) {
+        // COCO RLE为列优先，游程从背景开始交替
+        let index = 0;
+        payload.counts.forEach((count, i) => {
+            if (i % 2 === 1) {
+                for (let k = index; k < index + count; k++) {
+                    const x = Math.floor(k / height);
+                    const y = k - x * height;
+                    data[y * width + x] = 255;
+                }
+            }
+            index += count;
+        });
+        return data;
+    }
+    
+    // 位打包（行优先，高位在前）
+    const bytes = atob(payload.data);
+    for (let i = 0; i < data.length; i++) {
+        if ((bytes.charCodeAt(i >> 3) >> (7 - (i & 7))) & 1) {
+            data[i] = 255;
+        }
+    }
+    return data;
+}
+
 // 模拟SAM的回退函数
 async function simulateSAMFallback() {
     return new Promise((resolve) => {
@@ -1400,6 +1601,13 @@ function toggleMaskAnimation(enabled) {
     }
 }
 
+function toggleHoverPreview(enabled) {
+    if (annotator) {
+        annotator.setHoverPreview(enabled);
+        console.log('悬停实时预览:', enabled ? '启用' : '禁用');
+    }
+}
+
 function toggleCoordinateDisplay(enabled) {
     if (annotator) {
         annotator.showCoordinates = enabled;